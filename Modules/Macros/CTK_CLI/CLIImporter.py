@@ -1,6 +1,6 @@
 # Copyright (c) Fraunhofer MEVIS, Germany. All rights reserved.
 # **InsertLicense** code
-import os, re, glob, logging, cli_to_macro
+import os, re, logging, cli_to_macro, cli_cache, cli_discovery, cli_profiling
 from PythonQt import Qt, QtGui
 from mevis import MLABFileDialog
 
@@ -35,6 +35,14 @@ def doImport(field = None, window = None):
         os.mkdir(os.path.join(targetDirectory, "mhelp"))
 
     generateScreenshots = ctx.field('generatePanelScreenshots').value
+
+    cache = None
+    if ctx.field('useDescriptionCache').value:
+        cache = cli_cache.CLIDescriptionCache()
+
+    profile = None
+    if ctx.field('profileImport').value:
+        profile = cli_profiling.ImportProfile()
         
     pd = QtGui.QProgressDialog(window.widget() if window else None)
     pd.setWindowModality(Qt.Qt.WindowModal)
@@ -43,7 +51,13 @@ def doImport(field = None, window = None):
             importPaths, targetDirectory,
             includePanelScreenshots = generateScreenshots,
             env = mlabFreeEnvironment(),
-            unexpandFilename = ctx.unexpandFilename):
+            unexpandFilename = ctx.unexpandFilename,
+            jobs = ctx.field('parallelJobs').value,
+            cache = cache,
+            incremental = ctx.field('incrementalImport').value,
+            recursive = ctx.field('scanRecursively').value,
+            duplicatePolicy = ctx.field('duplicatePolicy').value,
+            profile = profile):
         if path:
             print("%d/%d importing %s..." % (index+1, total, path))
         pd.setValue(index)
@@ -53,6 +67,9 @@ def doImport(field = None, window = None):
         if pd.wasCanceled:
             break
 
+    if profile is not None and not pd.wasCanceled:
+        print(profile.summary())
+
     if not pd.wasCanceled:
         if successful:
             if generateScreenshots:
@@ -77,14 +94,15 @@ def doImport(field = None, window = None):
                     if total else
                     "No CLI modules found in the given directories.")
 
+def clearDescriptionCache():
+    cli_cache.CLIDescriptionCache().invalidate()
+
 def importAndClose():
     doImport(window = ctx.window())
 
 def init():
     if not ctx.field('importPaths').value:
-        found = []
-        for pattern in DEFAULT_SEARCH_PATHS:
-            found.extend(glob.glob(os.path.expanduser(pattern)))
+        found = cli_discovery.expandSearchPatterns(DEFAULT_SEARCH_PATHS)
         ctx.field('importPaths').value = PATH_SEP.join(found)
 
 def browseForDirectory():
@@ -0,0 +1,353 @@
+# Copyright (c) Fraunhofer MEVIS, Germany. All rights reserved.
+# **InsertLicense** code
+"""Persistent on-disk caching of CLI modules' XML self-descriptions
+(`CLIDescriptionCache`) and execution results (`CLIResultCache`).
+
+Running an executable with --xml is by far the most expensive part of
+importing a CLI module, so `CLIDescriptionCache` keeps the raw XML of
+every executable seen, keyed by its identity (real path, size and
+modification time, optionally plus a content hash).  As long as an
+executable does not change, re-importing it does not spawn any
+process.
+"""
+
+import os, json, shutil, hashlib, logging, tempfile, threading
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+def defaultCacheDirectory():
+    """Return the default base directory for persistent caches
+    (honoring $XDG_CACHE_HOME, falling back to ~/.cache)."""
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'MeVisLab-CLI')
+
+def fileHash(filename, blockSize = 1024 * 1024):
+    """Return SHA-1 hex digest of the contents of `filename`."""
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        while True:
+            block = f.read(blockSize)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+def executableFingerprint(executablePath, contentHash = False):
+    """Return dict identifying the given executable by its real path
+    (i.e. with symlinks resolved, so that all links to the same binary
+    share one fingerprint), size and modification time.  If
+    `contentHash` is set, the SHA-1 of the file contents is added."""
+    realPath = os.path.realpath(executablePath)
+    st = os.stat(realPath)
+    result = dict(path = realPath, size = st.st_size, mtime = st.st_mtime_ns)
+    if contentHash:
+        result['sha1'] = fileHash(realPath)
+    return result
+
+# mkstemp() creates files that are only accessible by the owner, but
+# atomicWrite() shall behave like open(filename, 'w') w.r.t. permissions:
+_umask = os.umask(0)
+os.umask(_umask)
+
+def mkstempFor(filename):
+    """Return (fd, tempFilename) tuple for a new temporary file in the
+    same directory as `filename`, which may later be moved into place
+    using `replaceFile`."""
+    directory, basename = os.path.split(filename)
+    return tempfile.mkstemp(
+        prefix = '.%s.' % basename, suffix = '.tmp', dir = directory or '.')
+
+def replaceFile(tempFilename, filename):
+    """Atomically replace `filename` by `tempFilename` (cf.
+    `mkstempFor`), keeping the permissions of the replaced file (or
+    using the default ones for new files)."""
+    try:
+        mode = os.stat(filename).st_mode & 0o777
+    except OSError:
+        mode = 0o666 & ~_umask
+    os.chmod(tempFilename, mode)
+    os.replace(tempFilename, filename)
+
+def atomicWrite(filename, data):
+    """Write `data` (bytes) to `filename` via a temporary file in the
+    same directory that is renamed into place, so that readers never
+    see partially written files."""
+    fd, tempFilename = mkstempFor(filename)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        replaceFile(tempFilename, filename)
+    except:
+        os.unlink(tempFilename)
+        raise
+
+def linkOrCopyFile(source, target):
+    """Make `target` a hard link to `source` if possible (i.e. within
+    the same file system), or else a copy.  An existing `target` is
+    replaced instead of being overwritten in place (which would change
+    all files linked to it)."""
+    if os.path.lexists(target):
+        os.unlink(target)
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+def evictLeastRecentlyUsed(directory, maxBytes, suffix):
+    """Remove files ending with `suffix` from `directory`, least
+    recently used (i.e. oldest mtime) first, until their total size
+    does not exceed `maxBytes`.  Returns the remaining total size."""
+    entries = []
+    totalBytes = 0
+    for entry in os.scandir(directory):
+        if not entry.name.endswith(suffix):
+            continue
+        try:
+            st = entry.stat()
+        except OSError:
+            continue # removed concurrently
+        entries.append((st.st_mtime_ns, st.st_size, entry.path))
+        totalBytes += st.st_size
+    entries.sort()
+    for mtime, size, filename in entries:
+        if totalBytes <= maxBytes:
+            break
+        try:
+            os.unlink(filename)
+        except OSError:
+            pass # removed concurrently
+        totalBytes -= size
+    return totalBytes
+
+
+class CLIDescriptionCache(object):
+    """Persistent cache of CLI executables' raw XML descriptions.
+    Entries are stored as one small JSON file per executable within
+    `directory` (by default, a 'descriptions' subdirectory of
+    `defaultCacheDirectory()`), and the least recently used ones are
+    removed as soon as the total size exceeds `maxBytes`.
+
+    Entries are validated against the executable's fingerprint (see
+    `executableFingerprint`).  With `contentHash` set, entries are
+    keyed and validated by the executables' contents instead, which
+    costs reading each executable, but lets identical copies share
+    one entry.  Instances may be used from multiple threads.
+
+    The directory is only scanned (on the first `put`, and when the
+    running total of the sizes written since then exceeds
+    `maxBytes`), so that filling the cache does not cost quadratic
+    time."""
+
+    SUFFIX = '.json'
+
+    def __init__(self, directory = None, maxBytes = DEFAULT_MAX_BYTES,
+                 contentHash = False):
+        if directory is None:
+            directory = os.path.join(defaultCacheDirectory(), 'descriptions')
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.contentHash = contentHash
+        self._totalBytes = None # (estimated) size of all entries
+        self._lock = threading.Lock()
+
+    def _entryFilename(self, fingerprint):
+        key = fingerprint['sha1'] if self.contentHash else fingerprint['path']
+        return os.path.join(self.directory, hashlib.sha1(
+            key.encode('utf-8', 'surrogateescape')).hexdigest() + self.SUFFIX)
+
+    def get(self, executablePath):
+        """Return cached XML description (bytes) of the given
+        executable, or None if there is no valid entry."""
+        fingerprint = executableFingerprint(executablePath, self.contentHash)
+        filename = self._entryFilename(fingerprint)
+        try:
+            with open(filename) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        stored = entry.get('fingerprint', {})
+        if self.contentHash:
+            # copies at other paths are fine, only contents matter:
+            if stored.get('sha1') != fingerprint['sha1']:
+                return None
+        elif stored != fingerprint:
+            return None
+        try:
+            os.utime(filename) # mark as recently used
+        except OSError:
+            pass
+        return entry['xml'].encode('utf-8', 'surrogateescape')
+
+    def put(self, executablePath, xml):
+        """Store XML description (bytes) of the given executable."""
+        fingerprint = executableFingerprint(executablePath, self.contentHash)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, exist_ok = True)
+        entry = dict(fingerprint = fingerprint,
+                     xml = xml.decode('utf-8', 'surrogateescape'))
+        data = json.dumps(entry).encode('ascii')
+        atomicWrite(self._entryFilename(fingerprint), data)
+        with self._lock:
+            if self._totalBytes is not None:
+                # (over-estimated if an entry was replaced, which just
+                # leads to an earlier re-scan)
+                self._totalBytes += len(data)
+            if self._totalBytes is None or self._totalBytes > self.maxBytes:
+                self._totalBytes = evictLeastRecentlyUsed(
+                    self.directory, self.maxBytes, self.SUFFIX)
+
+    def invalidate(self, executablePath = None):
+        """Remove cache entry for the given executable, or the whole
+        cache contents if `executablePath` is None."""
+        if executablePath is not None:
+            fingerprint = executableFingerprint(executablePath, self.contentHash)
+            filenames = [self._entryFilename(fingerprint)]
+        elif os.path.isdir(self.directory):
+            filenames = [entry.path for entry in os.scandir(self.directory)
+                         if entry.name.endswith(self.SUFFIX)]
+        else:
+            filenames = []
+        for filename in filenames:
+            try:
+                os.unlink(filename)
+            except OSError:
+                pass
+
+
+DEFAULT_RESULT_CACHE_BYTES = 2 * 1024 * 1024 * 1024
+
+def _directorySize(path):
+    result = 0
+    for entry in os.scandir(path):
+        try:
+            result += entry.stat().st_size
+        except OSError:
+            pass
+    return result
+
+class CLIResultCache(object):
+    """Persistent cache of CLI execution results, i.e. output files
+    and return parameter values (plus the standard output / error
+    texts).  Each entry is a subdirectory of `directory` (by default,
+    a 'results' subdirectory of `defaultCacheDirectory()`), named
+    after the entry's key (see `key`), and the least recently used
+    entries are removed as soon as the total size exceeds `maxBytes`.
+    Results larger than `MAX_ENTRY_FRACTION` of `maxBytes` are not
+    stored at all (they would evict most other entries).
+    Entries are written atomically, so instances of multiple processes
+    may share the same directory."""
+
+    RESULT_FILENAME = 'result.json'
+    MAX_ENTRY_FRACTION = 0.25
+
+    def __init__(self, directory = None, maxBytes = DEFAULT_RESULT_CACHE_BYTES):
+        if directory is None:
+            directory = os.path.join(defaultCacheDirectory(), 'results')
+        self.directory = directory
+        self.maxBytes = maxBytes
+
+    @staticmethod
+    def key(*components):
+        """Return key (hex string) for the given JSON-serializable
+        components (e.g. executable fingerprint, arguments and input
+        fingerprints)."""
+        return hashlib.sha1(json.dumps(components, sort_keys = True).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Return dict with 'outputs' (mapping output names to paths of
+        cached files, which must not be modified), 'returnParameters'
+        (dict), 'stdout' and 'stderr' entries, or None if there is no
+        entry for `key`."""
+        entryDirectory = os.path.join(self.directory, key)
+        resultFilename = os.path.join(entryDirectory, self.RESULT_FILENAME)
+        try:
+            with open(resultFilename) as f:
+                result = json.load(f)
+            os.utime(resultFilename) # mark as recently used
+        except (OSError, ValueError):
+            return None
+        result['outputs'] = dict(
+            (name, os.path.join(entryDirectory, filename))
+            for name, filename in result['outputs'].items())
+        return result
+
+    def put(self, key, outputs, returnParameters, stdout = '', stderr = ''):
+        """Store result for `key`; `outputs` maps output names to the
+        files to be copied (or hard-linked, cf. `linkOrCopyFile`) into
+        the cache, which must not be modified afterwards."""
+        try:
+            size = sum(os.path.getsize(filename) for filename in outputs.values())
+        except OSError:
+            return # (output not written?)
+        if size > self.maxBytes * self.MAX_ENTRY_FRACTION:
+            logger.info("not caching result of %d bytes" % size)
+            return
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, exist_ok = True)
+        tempDirectory = tempfile.mkdtemp(prefix = '.', suffix = '.tmp', dir = self.directory)
+        try:
+            result = dict(outputs = {}, returnParameters = returnParameters,
+                          stdout = stdout, stderr = stderr)
+            for index, (name, filename) in enumerate(sorted(outputs.items())):
+                # keep extension, so that readers can detect the file format:
+                cachedFilename = 'output%d%s' % (index, os.path.splitext(filename)[1])
+                linkOrCopyFile(filename, os.path.join(tempDirectory, cachedFilename))
+                result['outputs'][name] = cachedFilename
+            with open(os.path.join(tempDirectory, self.RESULT_FILENAME), 'w') as f:
+                json.dump(result, f)
+            entryDirectory = os.path.join(self.directory, key)
+            if os.path.exists(entryDirectory):
+                shutil.rmtree(entryDirectory, ignore_errors = True)
+            os.rename(tempDirectory, entryDirectory)
+        except OSError:
+            logger.warning("could not store result in %s" % self.directory, exc_info = True)
+            shutil.rmtree(tempDirectory, ignore_errors = True)
+            return
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the total size
+        does not exceed `maxBytes`."""
+        entries = []
+        totalBytes = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith('.'):
+                continue # (being written)
+            try:
+                mtime = os.stat(os.path.join(entry.path, self.RESULT_FILENAME)).st_mtime_ns
+                size = _directorySize(entry.path)
+            except OSError:
+                continue # removed concurrently
+            entries.append((mtime, size, entry.path))
+            totalBytes += size
+        entries.sort()
+        for mtime, size, path in entries:
+            if totalBytes <= self.maxBytes:
+                break
+            shutil.rmtree(path, ignore_errors = True)
+            totalBytes -= size
+
+    def invalidate(self):
+        """Remove all cached results."""
+        if os.path.isdir(self.directory):
+            for entry in os.scandir(self.directory):
+                shutil.rmtree(entry.path, ignore_errors = True)
+
+def test_linkOrCopyFile():
+    directory = tempfile.mkdtemp()
+    try:
+        source, target, other = [os.path.join(directory, name) for name in 'abc']
+        with open(source, 'wb') as f:
+            f.write(b'new')
+        with open(target, 'wb') as f:
+            f.write(b'old')
+        os.link(target, other)
+        linkOrCopyFile(source, target)
+        with open(target, 'rb') as f:
+            assert f.read() == b'new'
+        with open(other, 'rb') as f:
+            assert f.read() == b'old' # replaced, not overwritten
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,128 @@
+# Copyright (c) Fraunhofer MEVIS, Germany. All rights reserved.
+# **InsertLicense** code
+"""Notification about terminated CLI processes on the main thread.
+
+A `CompletionNotifier` waits for its process in a (daemon) thread.
+Within MeVisLab, the thread wakes up the main thread via a socket pair
+watched by a QSocketNotifier, so that callbacks run as soon as the
+process exited, without polling.  (Only if none of the
+ACTIVATED_SIGNALS can be connected, a QTimer checks for termination
+every EVENT_INTERVAL seconds instead.)  Without PythonQt (e.g. in
+scripts or tests), `waitProcessingEvents` waits for a threading.Event
+instead, and callbacks are only called from `poll`.
+"""
+
+import socket, threading
+
+try:
+    from PythonQt import QtCore
+except ImportError:
+    QtCore = None
+
+# interval (in seconds) for processing events without Qt (cf.
+# CompletionNotifier.waitProcessingEvents), and for the fallback timer:
+EVENT_INTERVAL = 0.05
+
+# signatures of QSocketNotifier's activated signal (Qt 5, Qt 6):
+ACTIVATED_SIGNALS = ('activated(int)',
+                     'activated(QSocketDescriptor,QSocketNotifier::Type)')
+
+class CompletionNotifier(object):
+    """Waits for the given subprocess.Popen object to terminate and
+    calls the registered callbacks (see `whenTerminated`) afterwards,
+    on the main thread."""
+
+    def __init__(self, process):
+        self.process = process
+        self.terminated = threading.Event()
+        self._callbacks = []
+        self._loops = []
+        self._notifier = None
+        self._timer = None
+        self._sockets = None # (None once termination has been noticed)
+        # whether callbacks are called without `poll`:
+        self.eventDriven = QtCore is not None
+        if self.eventDriven:
+            self._sockets = socket.socketpair()
+            self._notifier = QtCore.QSocketNotifier(
+                self._sockets[0].fileno(), QtCore.QSocketNotifier.Read)
+            if not any(self._notifier.connect(signal, self._activated)
+                       for signal in ACTIVATED_SIGNALS):
+                self._timer = QtCore.QTimer()
+                self._timer.connect('timeout()', self._checkTerminated)
+                self._timer.start(int(EVENT_INTERVAL * 1000))
+        self._thread = threading.Thread(
+            target = self._waitForProcess, name = 'CLICompletionWaiter', daemon = True)
+        self._thread.start()
+
+    def _waitForProcess(self):
+        self.process.wait()
+        sockets = self._sockets
+        self.terminated.set()
+        if sockets is not None:
+            try:
+                sockets[1].send(b'x')
+            except OSError:
+                pass # already closed by _checkTerminated
+
+    def _checkTerminated(self):
+        if self.terminated.is_set():
+            self._activated()
+
+    def _activated(self, *signalArgs):
+        if self._sockets is None:
+            return # already noticed
+        # (we are possibly called from the notifier's own signal, so it
+        # must not be deleted right now)
+        self._notifier.setEnabled(False)
+        self._notifier.deleteLater()
+        if self._timer is not None:
+            self._timer.stop()
+        for s in self._sockets:
+            s.close()
+        self._sockets = None
+        for loop in self._loops:
+            loop.quit()
+        self._runCallbacks()
+
+    def _runCallbacks(self):
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def isTerminated(self):
+        return self.terminated.is_set()
+
+    def whenTerminated(self, callback):
+        """Register `callback` to be called (without arguments) on the
+        main thread after the process terminated (immediately if it
+        already did and has been noticed)."""
+        self._callbacks.append(callback)
+        if self.terminated.is_set() and self._sockets is None:
+            self._runCallbacks()
+
+    def poll(self):
+        """Without Qt, callbacks need to be triggered by calling this
+        on the main thread; returns whether the process terminated."""
+        result = self.terminated.is_set()
+        if result and self._sockets is None:
+            self._runCallbacks()
+        return result
+
+    def waitProcessingEvents(self, processEvents = None):
+        """Block until the process terminated, processing GUI events
+        meanwhile (in a local Qt event loop, or by calling
+        `processEvents` every EVENT_INTERVAL seconds without Qt)."""
+        if self._sockets is not None and not self.terminated.is_set():
+            loop = QtCore.QEventLoop()
+            self._loops.append(loop)
+            try:
+                if self._sockets is not None: # (not yet activated)
+                    loop.exec_()
+            finally:
+                self._loops.remove(loop)
+        while not self.terminated.wait(EVENT_INTERVAL):
+            if processEvents is not None:
+                processEvents()
+        self._checkTerminated() # (no need to wait for the notifier)
+        self.poll()
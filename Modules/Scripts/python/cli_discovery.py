@@ -0,0 +1,289 @@
+# Copyright (c) Fraunhofer MEVIS, Germany. All rights reserved.
+# **InsertLicense** code
+"""Fast discovery of CLI executables, based on os.scandir().
+
+Directory listings are cached (per process) and only re-read when a
+directory's modification time changes, so that repeatedly expanding
+search path patterns or re-scanning large extension trees mostly
+costs one stat() call per directory.  Note that changes of a file's
+permissions do not change its directory's mtime; call
+`clearDiscoveryCache()` if you need to pick up such changes.
+"""
+
+import os, re, sys, fnmatch, logging, threading
+import concurrent.futures
+logger = logging.getLogger(__name__)
+
+from ctk_cli import isCLIExecutable
+from cli_cache import fileHash
+
+_MAGIC = re.compile('[*?[]')
+
+# maps directory path -> (mtime, listing), cf. _scanDirectory()
+_cache = {}
+_cacheLock = threading.Lock()
+
+def clearDiscoveryCache():
+    with _cacheLock:
+        _cache.clear()
+
+def _isCLIExecutableEntry(entry):
+    # same rules as ctk_cli.isCLIExecutable(), but avoiding extra stat calls
+    if not entry.is_file():
+        return False
+    if sys.platform.startswith('win'):
+        name = entry.name.lower() # be case insensitive
+        return name.endswith(".exe") or name.endswith(".bat")
+    if '.' in entry.name:
+        return False
+    return os.access(entry.path, os.X_OK)
+
+def _scanDirectory(path):
+    """Return listing of directory `path` as sorted tuple of (name,
+    isDirectory, isCLIExecutable) tuples.  Non-existing or unreadable
+    directories result in an empty listing."""
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return ()
+    with _cacheLock:
+        cached = _cache.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    listing = []
+    try:
+        for entry in os.scandir(path):
+            try:
+                isDirectory = entry.is_dir()
+                listing.append((entry.name, isDirectory,
+                                not isDirectory and _isCLIExecutableEntry(entry)))
+            except OSError:
+                pass # e.g. dangling symlink
+    except OSError:
+        return ()
+    listing = tuple(sorted(listing))
+    with _cacheLock:
+        _cache[path] = (mtime, listing)
+    return listing
+
+def isSearchPattern(path):
+    """Return whether `path` contains glob-style wildcards."""
+    return _MAGIC.search(path) is not None
+
+def expandSearchPattern(pattern):
+    """Return sorted list of existing directories matching the given
+    glob-style `pattern` (with '~' being expanded to the user's home
+    directory).  Like glob.glob(), wildcards do not match leading
+    dots."""
+    pattern = os.path.expanduser(pattern)
+    if not _MAGIC.search(pattern):
+        return [pattern] if os.path.isdir(pattern) else []
+
+    separators = os.sep + (os.altsep or '')
+    drive, rest = os.path.splitdrive(pattern)
+    if rest[:1] and rest[0] in separators:
+        candidates = [drive + os.sep]
+    else:
+        candidates = [drive]
+    for component in re.split('[%s]+' % re.escape(separators), rest.strip(separators)):
+        if _MAGIC.search(component):
+            candidates = [
+                os.path.join(candidate, name)
+                for candidate in candidates
+                for name, isDirectory, _ in _scanDirectory(candidate or os.curdir)
+                if isDirectory and fnmatch.fnmatch(name, component)
+                and (component.startswith('.') or not name.startswith('.'))]
+        else:
+            candidates = [os.path.join(candidate, component) for candidate in candidates]
+    return [candidate for candidate in candidates if os.path.isdir(candidate)]
+
+def expandSearchPatterns(patterns):
+    """Return list of directories matching any of the given patterns
+    (see `expandSearchPattern`), without duplicates."""
+    result = []
+    for pattern in patterns:
+        for path in expandSearchPattern(pattern):
+            if path not in result:
+                result.append(path)
+    return result
+
+def _listCLIExecutables(baseDir, maxDepth, jobs):
+    baseDir = os.path.normpath(baseDir)
+    listings = {}
+    visited = set()
+    level = [baseDir]
+    depth = 0
+    executor = None
+    if jobs is not None and jobs > 1:
+        executor = concurrent.futures.ThreadPoolExecutor(jobs)
+    try:
+        while level:
+            if executor is not None and len(level) > 1:
+                levelListings = executor.map(_scanDirectory, level)
+            else:
+                levelListings = map(_scanDirectory, level)
+            nextLevel = []
+            for path, listing in zip(level, levelListings):
+                listings[path] = listing
+                if maxDepth is not None and depth >= maxDepth:
+                    continue
+                for name, isDirectory, _ in listing:
+                    if not isDirectory:
+                        continue
+                    subDir = os.path.join(path, name)
+                    realPath = os.path.realpath(subDir)
+                    if realPath not in visited: # prevent symlink loops
+                        visited.add(realPath)
+                        nextLevel.append(subDir)
+            level = nextLevel
+            depth += 1
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    # return results in depth-first order, independent of scheduling:
+    result = []
+    def collect(path):
+        listing = listings[path]
+        for name, isDirectory, isExecutable in listing:
+            if isExecutable:
+                result.append(os.path.join(path, name))
+        for name, isDirectory, _ in listing:
+            subDir = os.path.join(path, name)
+            if isDirectory and subDir in listings:
+                collect(subDir)
+    collect(baseDir)
+    return result
+
+def findCLIExecutables(importPaths, recursive = False, maxDepth = None, jobs = None):
+    """Return list of CLI executables (cf. ctk_cli.isCLIExecutable)
+    found within `importPaths`, which may contain directories or
+    executables.  Directories are scanned non-recursively, unless
+    `recursive` is set (then, `maxDepth` may limit the number of
+    directory levels below each given directory).  With `jobs` > 1,
+    directories of the same level are scanned by that many threads in
+    parallel.  Executables within one directory are sorted by name,
+    and are listed before those within subdirectories."""
+    result = []
+    for path in importPaths:
+        if os.path.isdir(path):
+            result.extend(_listCLIExecutables(
+                path, maxDepth if recursive else 0, jobs))
+        elif isCLIExecutable(path):
+            result.append(path)
+    return result
+
+def cliModuleName(executablePath):
+    """Return name of the CLI module provided by the given executable
+    (the same as ctk_cli.CLIModule.name)."""
+    result = os.path.basename(executablePath)
+    base, ext = os.path.splitext(result)
+    if ext in ('.exe', '.xml', '.py'):
+        result = base
+    return result
+
+DUPLICATE_POLICIES = ('newest', 'first', 'last')
+
+def _versionKey(executablePath):
+    # sort key for the 'newest' policy: Slicer version, extension
+    # revision (taken from the path), then modification time
+    versions = re.findall(r'Slicer-([0-9]+(?:\.[0-9]+)*)', executablePath)
+    revisions = re.findall(r'Extensions-([0-9]+)', executablePath)
+    try:
+        mtime = os.stat(executablePath).st_mtime
+    except OSError:
+        mtime = 0
+    return (tuple(int(v) for v in versions[-1].split('.')) if versions else (),
+            int(revisions[-1]) if revisions else 0,
+            mtime)
+
+def deduplicateCLIExecutables(executablePaths, policy = 'newest', contentHash = False):
+    """Filter list of CLI executables such that only one executable is
+    kept per CLI module name (since importing the others would just
+    overwrite the same generated module).  Identical copies (i.e.
+    paths resolving to the same file, or files with the same content
+    if `contentHash` is set) are always collapsed.  If different
+    executables provide the same module, `policy` decides which one
+    to keep:
+
+    'newest'
+      the one with the highest Slicer version / extension revision
+      within its path (falling back to the modification time)
+    'first'
+      the first one in `executablePaths`
+    'last'
+      the last one in `executablePaths`
+
+    The result keeps the original order of the remaining paths."""
+    if policy not in DUPLICATE_POLICIES:
+        raise ValueError("unknown duplicate policy %r (expected one of %s)" % (
+            policy, ", ".join(DUPLICATE_POLICIES)))
+
+    candidates = {} # module name -> list of (index, path)
+    seen = set()
+    for index, path in enumerate(executablePaths):
+        identity = fileHash(path) if contentHash else os.path.realpath(path)
+        if identity in seen:
+            logger.info("skipping %s (identical copy)" % path)
+            continue
+        seen.add(identity)
+        candidates.setdefault(cliModuleName(path), []).append((index, path))
+
+    keep = set()
+    for name, group in candidates.items():
+        if policy == 'first':
+            index, path = group[0]
+        elif policy == 'last':
+            index, path = group[-1]
+        else:
+            # max() returns the first maximal element, i.e. 'first' on ties
+            index, path = max(group, key = lambda entry: _versionKey(entry[1]))
+        keep.add(index)
+        for _, other in group:
+            if other != path:
+                logger.info("skipping %s (using %s instead)" % (other, path))
+    return [path for index, path in enumerate(executablePaths) if index in keep]
+
+def test_versionKey():
+    older = '/opt/Slicer-4.9.0/lib/Slicer-4.9/cli-modules/BRAINSFit'
+    newer = '/opt/Slicer-4.10.2/lib/Slicer-4.10/cli-modules/BRAINSFit'
+    assert _versionKey(older) < _versionKey(newer) # numeric, not lexicographic
+    assert _versionKey('/ext/Extensions-27501/Tool/cli-modules/Tool')[:2] == ((), 27501)
+    assert (_versionKey('/Slicer-4.10/Extensions-100/Tool') <
+            _versionKey('/Slicer-4.10/Extensions-99999/Tool') <
+            _versionKey('/Slicer-4.11/Extensions-1/Tool'))
+    assert _versionKey('/no/such/Tool') == ((), 0, 0)
+
+def test_deduplicate_policies():
+    paths = ['/Slicer-4.11/cli-modules/Blur',
+             '/Slicer-4.10/cli-modules/Blur',
+             '/Slicer-4.10/cli-modules/Other.exe',
+             '/Slicer-4.12/cli-modules/Blur']
+    assert deduplicateCLIExecutables(paths, 'first') == [paths[0], paths[2]]
+    assert deduplicateCLIExecutables(paths, 'last') == paths[2:]
+    assert deduplicateCLIExecutables(paths[:3], 'newest') == paths[:1] + paths[2:3]
+    assert deduplicateCLIExecutables(paths, 'newest') == paths[2:]
+    assert deduplicateCLIExecutables(paths[:1] * 2) == paths[:1]
+    try:
+        deduplicateCLIExecutables(paths, 'oldest')
+    except ValueError:
+        pass
+    else:
+        assert False, 'unknown policy not rejected'
+
+def test_deduplicate_identical_copies():
+    import tempfile, shutil
+    directory = tempfile.mkdtemp()
+    try:
+        paths = []
+        for name, content in (('a', b'same'), ('b', b'same'), ('c', b'different')):
+            os.mkdir(os.path.join(directory, name))
+            paths.append(os.path.join(directory, name, 'Tool'))
+            with open(paths[-1], 'wb') as f:
+                f.write(content)
+        # different content: the policy decides
+        assert deduplicateCLIExecutables(paths[1:], 'last') == paths[2:]
+        # identical copies are collapsed before applying the policy
+        assert deduplicateCLIExecutables(paths[:2], 'last', contentHash = True) == paths[:1]
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,144 @@
+# Copyright (c) Fraunhofer MEVIS, Germany. All rights reserved.
+# **InsertLicense** code
+"""Import CLI modules into a MeVisLab module tree, without MeVisLab.
+
+This is the headless equivalent of the CLIImporter macro module, e.g.
+for pre-generating modules on build servers::
+
+  python cli_import.py -o Modules/Macros/CTK_CLI/generated --incremental \\
+      '/opt/Slicer-*/lib/Slicer-*/cli-modules'
+
+Progress is reported on stdout as JSON lines (one object per line,
+flushed immediately), with an 'event' key being one of
+
+start
+  {"event": "start", "total": <number of executables found>}
+module
+  one per executable, after it has been processed: {"event":
+  "module", "index": ..., "path": ..., "ok": true/false, "error":
+  <message or null>} (plus "profile" if --profile is given)
+done
+  {"event": "done", "successful": ..., "total": ..., "failed": [<paths>]}
+
+Log messages go to stderr.  The exit code is 0 if all modules could
+be imported, 1 if some failed, and 2 for invalid arguments.
+"""
+
+import os, sys, json, time, argparse, logging
+
+import cli_to_macro, cli_cache, cli_discovery, cli_profiling
+
+def expandImportPaths(patterns):
+    """Expand glob-style search path patterns (cf.
+    `cli_discovery.expandSearchPattern`); other paths (e.g. of
+    single executables) are passed through unchanged."""
+    result = []
+    for pattern in patterns:
+        if cli_discovery.isSearchPattern(pattern):
+            paths = cli_discovery.expandSearchPattern(pattern)
+        else:
+            paths = [os.path.expanduser(pattern)]
+        for path in paths:
+            if path not in result:
+                result.append(path)
+    return result
+
+def _emit(stream, **event):
+    stream.write(json.dumps(event, sort_keys = True) + '\n')
+    stream.flush()
+
+def _parser():
+    parser = argparse.ArgumentParser(description = __doc__.split('\n\n')[0])
+    parser.add_argument('paths', nargs = '+', metavar = 'PATH',
+                        help = 'directories to be scanned for CLI executables '
+                        '(may contain wildcards), or paths of single executables')
+    parser.add_argument('--target', '-o', required = True,
+                        help = 'directory the generated files are written to')
+    parser.add_argument('--def-file', default = 'CLIModules.def',
+                        help = 'name of the generated .def file (default: %(default)s)')
+    parser.add_argument('--jobs', '-j', type = int, default = os.cpu_count() or 1,
+                        help = 'number of executables queried in parallel '
+                        '(default: number of CPUs, %(default)s)')
+    parser.add_argument('--timeout', type = float, default = cli_to_macro.DEFAULT_XML_TIMEOUT,
+                        help = 'seconds after which an executable not providing its '
+                        'XML description gets killed (default: %(default)s)')
+    parser.add_argument('--recursive', '-r', action = 'store_true',
+                        help = 'scan subdirectories, too')
+    parser.add_argument('--max-depth', type = int, default = None,
+                        help = 'maximum number of subdirectory levels scanned with --recursive')
+    parser.add_argument('--duplicates', choices = cli_discovery.DUPLICATE_POLICIES + ('all',),
+                        default = 'newest',
+                        help = 'which executable to import if several provide the same '
+                        'module (default: %(default)s)')
+    parser.add_argument('--incremental', '-i', action = 'store_true',
+                        help = 'only regenerate modules for added or changed executables, '
+                        'and remove modules of executables that are gone')
+    parser.add_argument('--cache-dir', default = None,
+                        help = 'directory of the XML description cache (default: %s)'
+                        % os.path.join(cli_cache.defaultCacheDirectory(), 'descriptions'))
+    parser.add_argument('--no-cache', action = 'store_true',
+                        help = 'do not use the XML description cache')
+    parser.add_argument('--panel-screenshots', action = 'store_true',
+                        help = 'reference panel screenshots from the generated help '
+                        '(which have to be generated within MeVisLab)')
+    parser.add_argument('--profile', action = 'store_true',
+                        help = 'report per-module timings (and write %s)'
+                        % cli_profiling.REPORT_FILENAME)
+    parser.add_argument('--verbose', '-v', action = 'count', default = 0,
+                        help = 'log more details to stderr (may be repeated)')
+    return parser
+
+def main(argv = None, stream = sys.stdout):
+    args = _parser().parse_args(argv)
+
+    logging.basicConfig(
+        stream = sys.stderr, format = '%(levelname)s: %(message)s',
+        level = (logging.WARNING, logging.INFO, logging.DEBUG)[min(args.verbose, 2)])
+
+    targetDirectory = os.path.expanduser(args.target)
+    os.makedirs(os.path.join(targetDirectory, 'mhelp'), exist_ok = True)
+
+    cache = None
+    if not args.no_cache:
+        cache = cli_cache.CLIDescriptionCache(args.cache_dir)
+
+    profile = None
+    if args.profile:
+        profile = cli_profiling.ImportProfile()
+
+    startTime = time.perf_counter()
+    failed = []
+    successful = total = 0
+    for progress in cli_to_macro.importAllCLIs(
+            expandImportPaths(args.paths), targetDirectory,
+            defFileName = args.def_file,
+            includePanelScreenshots = args.panel_screenshots,
+            jobs = args.jobs,
+            timeout = args.timeout,
+            cache = cache,
+            incremental = args.incremental,
+            recursive = args.recursive,
+            maxDepth = args.max_depth,
+            duplicatePolicy = None if args.duplicates == 'all' else args.duplicates,
+            profile = profile):
+        index, successful, total, path = progress
+        if progress.previousPath is None:
+            _emit(stream, event = 'start', total = total)
+        else:
+            event = dict(index = index - 1, path = progress.previousPath,
+                         ok = progress.error is None, error = progress.error)
+            if progress.profile is not None:
+                event['profile'] = progress.profile.asDict()['phases']
+            _emit(stream, event = 'module', **event)
+            if progress.error is not None:
+                failed.append(progress.previousPath)
+    _emit(stream, event = 'done', successful = successful, total = total,
+          failed = failed, elapsed = round(time.perf_counter() - startTime, 3))
+
+    if profile is not None:
+        sys.stderr.write(profile.summary() + '\n')
+
+    return 0 if successful == total else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
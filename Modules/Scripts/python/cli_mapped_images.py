@@ -0,0 +1,376 @@
+# Copyright (c) Fraunhofer MEVIS, Germany. All rights reserved.
+# **InsertLicense** code
+"""Writing ML images as MetaImage (.mhd/.raw) files via memory mapping.
+
+Instead of serializing an input image with an itkImageFileWriter,
+`writeMappedImage` creates a small .mhd header and a detached .raw
+file, which is memory-mapped (using numpy.memmap) and filled directly
+from the image's tiles.  Since the voxel data starts at offset 0 of
+the .raw file, it is page-aligned, and when the file lives in a
+RAM-backed workspace (cf. cli_workspace), the CLI process reads the
+very same pages.
+
+Only scalar 3D images are supported (i.e. no channel, time, or u
+dimensions); `canMapImage` tells whether an image qualifies.  numpy is
+an optional dependency: without it, no image qualifies.
+
+Alternatively, the .raw file may be a named pipe into which the voxels
+are streamed while the CLI is already running (see
+`createStreamedImage` and `ImageStreamer`; POSIX only).
+"""
+
+import os, sys, math, time, errno, queue, threading
+import concurrent.futures
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+HEADER_EXTENSION = '.mhd'
+DATA_EXTENSION = '.raw'
+
+# number of voxels fetched at once by writeMappedImage():
+MAPPING_CHUNK_VOXELS = 16 * 1024 * 1024
+
+_ELEMENT_TYPES = {
+    'int8' : 'MET_CHAR',
+    'uint8' : 'MET_UCHAR',
+    'int16' : 'MET_SHORT',
+    'uint16' : 'MET_USHORT',
+    'int32' : 'MET_INT',
+    'uint32' : 'MET_UINT',
+    'int64' : 'MET_LONG_LONG',
+    'uint64' : 'MET_ULONG_LONG',
+    'float32' : 'MET_FLOAT',
+    'float64' : 'MET_DOUBLE',
+    }
+
+def dataFilename(headerFilename):
+    """Return filename of the .raw file belonging to the given .mhd file."""
+    return os.path.splitext(headerFilename)[0] + DATA_EXTENSION
+
+def _elementType(image):
+    tile = image.getTile((0, 0, 0, 0, 0, 0), (1, 1, 1, 1, 1, 1))
+    return tile.dtype, _ELEMENT_TYPES.get(tile.dtype.name)
+
+def canMapImage(image):
+    """Return whether `writeMappedImage` supports the given image."""
+    if numpy is None:
+        return False
+    sx, sy, sz, sc, st, su = image.imageExtent()
+    if (sc, st, su) != (1, 1, 1):
+        return False
+    dtype, elementType = _elementType(image)
+    return elementType is not None
+
+def metaImageGeometry(voxelToWorldMatrix):
+    """Return (offset, spacing, axes) tuple for MetaImage headers from
+    the given ML voxel-to-world matrix (which refers to voxel corners,
+    while MetaImage / ITK refer to voxel centers)."""
+    m = [list(row) for row in voxelToWorldMatrix]
+    offset = [sum(m[i][j] * 0.5 for j in range(3)) + m[i][3] for i in range(3)]
+    spacing, axes = [], []
+    for j in range(3):
+        column = [m[i][j] for i in range(3)]
+        length = math.sqrt(sum(c * c for c in column)) or 1.0
+        spacing.append(length)
+        axes.append([c / length for c in column])
+    return offset, spacing, axes
+
+def _formatNumbers(values):
+    return ' '.join(repr(float(v)) for v in values)
+
+def _mapDataFile(rawFilename, dtype, shape):
+    size = dtype.itemsize
+    for n in shape:
+        size *= n
+    if os.path.lexists(rawFilename) and not os.path.isfile(rawFilename):
+        os.unlink(rawFilename) # (named pipe, cf. createStreamedImage)
+    # re-use existing pages if possible:
+    mode = 'r+' if (os.path.exists(rawFilename) and os.path.getsize(rawFilename) == size) else 'w+'
+    return numpy.memmap(rawFilename, dtype = dtype, mode = mode, shape = shape)
+
+def _writeHeader(headerFilename, shape, dtype, voxelToWorldMatrix):
+    sz, sy, sx = shape
+    offset, spacing, axes = metaImageGeometry(voxelToWorldMatrix)
+    header = [
+        'ObjectType = Image',
+        'NDims = 3',
+        'BinaryData = True',
+        'BinaryDataByteOrderMSB = %s' % (sys.byteorder == 'big'),
+        'CompressedData = False',
+        'TransformMatrix = %s' % _formatNumbers(sum(axes, [])),
+        'Offset = %s' % _formatNumbers(offset),
+        'CenterOfRotation = 0 0 0',
+        'ElementSpacing = %s' % _formatNumbers(spacing),
+        'DimSize = %d %d %d' % (sx, sy, sz),
+        'ElementType = %s' % _ELEMENT_TYPES[dtype.name],
+        # (must be the last entry)
+        'ElementDataFile = %s' % os.path.basename(dataFilename(headerFilename)),
+        ]
+    with open(headerFilename, 'w') as f:
+        f.write('\n'.join(header) + '\n')
+
+def writeMappedImage(image, headerFilename, chunkVoxels = MAPPING_CHUNK_VOXELS):
+    """Write the given (paged) image to `headerFilename` (.mhd) and
+    its .raw file (see `dataFilename`), which is returned.  The image
+    must be supported (see `canMapImage`).  An existing .raw file of
+    the right size is overwritten in-place (re-using its pages)."""
+    sx, sy, sz = image.imageExtent()[:3]
+    dtype, elementType = _elementType(image)
+    rawFilename = dataFilename(headerFilename)
+
+    mapped = _mapDataFile(rawFilename, dtype, (sz, sy, sx))
+    try:
+        slabDepth = max(1, chunkVoxels // max(1, sx * sy))
+        for z in range(0, sz, slabDepth):
+            depth = min(slabDepth, sz - z)
+            tile = image.getTile((0, 0, z, 0, 0, 0), (sx, sy, depth, 1, 1, 1))
+            mapped[z:z + depth] = tile.reshape((depth, sy, sx))
+        mapped.flush()
+    finally:
+        del mapped
+
+    _writeHeader(headerFilename, (sz, sy, sx), dtype, image.voxelToWorldMatrix())
+    return rawFilename
+
+# maximum number of slabs queued by `writeMappedImageInBackground`:
+MAX_PENDING_SLABS = 2
+
+_END = 'end'
+_ABORT = 'abort'
+
+def _writeSlabs(slabs, headerFilename, dtype, shape, voxelToWorldMatrix):
+    rawFilename = dataFilename(headerFilename)
+    writeTime = 0.0
+    item = None
+    try:
+        start = time.perf_counter()
+        mapped = _mapDataFile(rawFilename, dtype, shape)
+        writeTime += time.perf_counter() - start
+        try:
+            while True:
+                item = slabs.get()
+                if item is _ABORT:
+                    raise RuntimeError('fetching image failed')
+                start = time.perf_counter()
+                if item is _END:
+                    mapped.flush()
+                    writeTime += time.perf_counter() - start
+                    break
+                z, tile = item
+                mapped[z:z + len(tile)] = tile
+                writeTime += time.perf_counter() - start
+        finally:
+            del mapped
+    except:
+        # keep consuming, so that the producer does not block forever:
+        while item is not _END and item is not _ABORT:
+            item = slabs.get()
+        raise
+    _writeHeader(headerFilename, shape, dtype, voxelToWorldMatrix)
+    return rawFilename, writeTime
+
+def writeMappedImageInBackground(image, headerFilename, executor,
+                                 chunkVoxels = MAPPING_CHUNK_VOXELS,
+                                 maxPending = MAX_PENDING_SLABS):
+    """Like `writeMappedImage`, but the slabs fetched on the calling
+    thread (ML images must only be accessed from the main thread) are
+    copied into the file by a task submitted to `executor`.  At most
+    `maxPending` slabs are queued (blocking the caller), so that
+    fetching and writing overlap without needing a copy of the whole
+    image in memory.  Returns a future for a (rawFilename, writeTime)
+    tuple, writeTime being the time spent writing (excluding waiting
+    for slabs)."""
+    sx, sy, sz = image.imageExtent()[:3]
+    dtype, elementType = _elementType(image)
+    slabs = queue.Queue(maxPending)
+    future = executor.submit(_writeSlabs, slabs, headerFilename, dtype, (sz, sy, sx),
+                             image.voxelToWorldMatrix())
+    try:
+        slabDepth = max(1, chunkVoxels // max(1, sx * sy))
+        for z in range(0, sz, slabDepth):
+            depth = min(slabDepth, sz - z)
+            tile = image.getTile((0, 0, z, 0, 0, 0), (sx, sy, depth, 1, 1, 1))
+            slabs.put((z, tile.reshape((depth, sy, sx))))
+    except:
+        slabs.put(_ABORT)
+        concurrent.futures.wait([future]) # (before our caller cleans up)
+        raise
+    slabs.put(_END)
+    return future
+
+def fetchImage(image):
+    """Return (voxels, voxelToWorldMatrix) tuple for the given
+    supported image, with the voxels as numpy array of shape (z, y,
+    x), e.g. for streaming it from another thread (see
+    `createStreamedImage`), since ML images must only be accessed from
+    the main thread."""
+    sx, sy, sz = image.imageExtent()[:3]
+    voxels = image.getTile((0, 0, 0, 0, 0, 0), (sx, sy, sz, 1, 1, 1))
+    return voxels.reshape((sz, sy, sx)), image.voxelToWorldMatrix()
+
+def createStreamedImage(voxels, voxelToWorldMatrix, headerFilename):
+    """Write the .mhd header for the result of `fetchImage`, but
+    create the .raw file as named pipe (FIFO), into which an
+    `ImageStreamer` writes the voxels while the CLI reads them.
+    Returns the .raw filename."""
+    rawFilename = dataFilename(headerFilename)
+    if os.path.lexists(rawFilename):
+        os.unlink(rawFilename)
+    os.mkfifo(rawFilename, 0o600)
+    _writeHeader(headerFilename, voxels.shape, voxels.dtype, voxelToWorldMatrix)
+    return rawFilename
+
+def canStreamImages():
+    return numpy is not None and hasattr(os, 'mkfifo')
+
+class ImageStreamer(threading.Thread):
+    """Thread writing voxels into the named pipe created by
+    `createStreamedImage`, as soon as the given process opens it.
+    Afterwards, `completed` tells whether all voxels were consumed;
+    this is not the case if the process terminated without opening the
+    pipe, or closed it early (e.g. because it needs a seekable file),
+    in which case `error` is a BrokenPipeError."""
+
+    CHUNK_BYTES = 1024 * 1024
+
+    def __init__(self, voxels, rawFilename, process):
+        threading.Thread.__init__(self, name = 'CLIImageStreamer', daemon = True)
+        self.voxels = numpy.ascontiguousarray(voxels)
+        self.rawFilename = rawFilename
+        self.process = process
+        self.completed = False
+        self.error = None
+
+    def _open(self):
+        # (opening a FIFO for writing blocks until there is a reader,
+        # which may never come, so poll non-blockingly)
+        while True:
+            try:
+                return os.open(self.rawFilename, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError as e:
+                if e.errno != errno.ENXIO:
+                    raise
+            if self.process.poll() is not None:
+                return None
+            time.sleep(0.005)
+
+    def run(self):
+        try:
+            fd = self._open()
+            if fd is None:
+                return
+            try:
+                os.set_blocking(fd, True)
+                data = memoryview(self.voxels).cast('B')
+                start = 0
+                while start < len(data):
+                    # (partial write, then BrokenPipeError if the reader
+                    # closes early)
+                    start += os.write(fd, data[start:start + self.CHUNK_BYTES])
+                self.completed = True
+            finally:
+                os.close(fd)
+        except OSError as e:
+            self.error = e
+        finally:
+            self.voxels = None
+
+def test_metaImageGeometry():
+    # voxel corner (0,0,0) at (10,20,30), spacing (2,3,4), no rotation:
+    offset, spacing, axes = metaImageGeometry(
+        [[2, 0, 0, 10], [0, 3, 0, 20], [0, 0, 4, 30], [0, 0, 0, 1]])
+    assert offset == [11, 21.5, 32] # center of first voxel
+    assert spacing == [2, 3, 4]
+    assert axes == [[1, 0, 0], [0, 1, 0], [0, 0, 1]]
+
+def test_metaImageGeometry_rotated():
+    # x axis mapped to world y, y axis mapped to world -x:
+    offset, spacing, axes = metaImageGeometry(
+        [[0, -3, 0, 10], [2, 0, 0, 20], [0, 0, 4, 30], [0, 0, 0, 1]])
+    assert offset == [8.5, 21, 32]
+    assert spacing == [2, 3, 4]
+    assert axes == [[0, 1, 0], [-1, 0, 0], [0, 0, 1]]
+
+class _TestImage(object):
+    # mimics the parts of ML images used here
+    def __init__(self, voxels):
+        self.voxels = voxels # (z, y, x) array
+        self.getTileCalls = 0
+    def imageExtent(self):
+        sz, sy, sx = self.voxels.shape
+        return (sx, sy, sz, 1, 1, 1)
+    def getTile(self, position, size):
+        self.getTileCalls += 1
+        x, y, z = position[:3]
+        sx, sy, sz = size[:3]
+        return self.voxels[z:z + sz, y:y + sy, x:x + sx].reshape(size[::-1])
+    def voxelToWorldMatrix(self):
+        return [[2, 0, 0, 10], [0, 3, 0, 20], [0, 0, 4, 30], [0, 0, 0, 1]]
+
+def test_header():
+    if numpy is None:
+        return
+    import tempfile, shutil
+    directory = tempfile.mkdtemp()
+    try:
+        headerFilename = os.path.join(directory, 'image' + HEADER_EXTENSION)
+        image = _TestImage(numpy.arange(24, dtype = numpy.int16).reshape((4, 3, 2)))
+        rawFilename = writeMappedImage(image, headerFilename)
+        with open(headerFilename) as f:
+            header = dict(line.split(' = ') for line in f.read().splitlines())
+        assert header['DimSize'] == '2 3 4' # x, y, z
+        assert header['Offset'] == '11.0 21.5 32.0'
+        assert header['ElementType'] == 'MET_SHORT'
+        assert header['ElementDataFile'] == os.path.basename(rawFilename)
+        with open(rawFilename, 'rb') as f:
+            assert f.read() == image.voxels.tobytes()
+    finally:
+        shutil.rmtree(directory)
+
+def test_writeMappedImageInBackground():
+    if numpy is None:
+        return
+    import tempfile, shutil
+    directory = tempfile.mkdtemp()
+    executor = concurrent.futures.ThreadPoolExecutor(1)
+    try:
+        headerFilename = os.path.join(directory, 'image' + HEADER_EXTENSION)
+        image = _TestImage(numpy.arange(7 * 3 * 2, dtype = numpy.float32).reshape((7, 3, 2)))
+        future = writeMappedImageInBackground(image, headerFilename, executor,
+                                              chunkVoxels = 6, maxPending = 1)
+        rawFilename, writeTime = future.result()
+        assert image.getTileCalls == 1 + 7 # (element type, slabs)
+        with open(rawFilename, 'rb') as f:
+            assert f.read() == image.voxels.tobytes()
+        assert os.path.exists(headerFilename)
+    finally:
+        executor.shutdown()
+        shutil.rmtree(directory)
+
+def test_ImageStreamer():
+    if not canStreamImages():
+        return
+    import tempfile, shutil, subprocess
+    directory = tempfile.mkdtemp()
+    try:
+        headerFilename = os.path.join(directory, 'image' + HEADER_EXTENSION)
+        voxels = numpy.zeros((64, 64, 64), numpy.int16)
+        def stream(script):
+            rawFilename = createStreamedImage(voxels, numpy.eye(4), headerFilename)
+            process = subprocess.Popen([sys.executable, '-c', script, rawFilename])
+            streamer = ImageStreamer(voxels, rawFilename, process)
+            streamer.start()
+            process.wait()
+            streamer.join()
+            return streamer
+        streamer = stream('import sys; open(sys.argv[1], "rb").read()')
+        assert streamer.completed and streamer.error is None
+        streamer = stream('import os, sys; os.read(os.open(sys.argv[1], os.O_RDONLY), 10)')
+        assert not streamer.completed and isinstance(streamer.error, BrokenPipeError)
+        streamer = stream('pass') # never opens the pipe
+        assert not streamer.completed and streamer.error is None
+    finally:
+        shutil.rmtree(directory)
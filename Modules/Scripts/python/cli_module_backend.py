@@ -0,0 +1,1102 @@
+# Copyright (c) Fraunhofer MEVIS, Germany. All rights reserved.
+# **InsertLicense** code
+"""Backend of the generated CLI macro modules.
+
+This module is imported only once per process; every macro instance
+creates its own `CLIModuleBackend` object (bound to the instance's
+ctx) in the thin CLIModuleBackend.py shim sourced by the generated
+.script files, which just forwards the MDL commands to it.
+"""
+
+import os, sys, shutil, time, zlib, concurrent.futures
+from ctk_cli import popenCLIExecutable
+from mevis import MLAB
+
+from cli_to_macro import fieldName, loadEmbeddedCLIModule, DESCRIPTION_SUFFIX
+from cli_discovery import cliModuleName
+from cli_cache import CLIResultCache, executableFingerprint, linkOrCopyFile
+from cli_workspace import Workspace, defaultManager
+from cli_completion import CompletionNotifier
+from cli_output_capture import OutputCapture
+from cli_progress import ProgressParser, estimateRemainingTime
+from cli_mapped_images import canMapImage, writeMappedImage, writeMappedImageInBackground, fetchImage, \
+     dataFilename, HEADER_EXTENSION, canStreamImages, createStreamedImage, ImageStreamer
+from mlab_free_environment import mlabFreeEnvironment
+
+# maps result keys (see CLIExecution.computeResultKey) to the running
+# CLIExecution computing that result, cf. CLIExecution.attach():
+_inFlight = {}
+
+_resultCache = None
+
+# paths of CLI executables that failed to read streamed input images
+# (cf. CLIExecution.saveInputImages), which get regular files instead:
+_requiresRegularFiles = set()
+
+def resultCache():
+    """Return the CLIResultCache shared by all CLI modules of this process."""
+    global _resultCache
+    if _resultCache is None:
+        _resultCache = CLIResultCache()
+    return _resultCache
+
+# maximum number of input images written concurrently (cf.
+# CLIExecution.saveInputImages):
+SAVE_WORKERS = min(4, os.cpu_count() or 1)
+
+_savePool = None
+
+def savePool():
+    """Return the thread pool for writing input images (shared by all
+    CLI modules of this process)."""
+    global _savePool
+    if _savePool is None:
+        _savePool = concurrent.futures.ThreadPoolExecutor(
+            SAVE_WORKERS, thread_name_prefix = 'CLIInputSaver')
+    return _savePool
+
+# interval (in seconds) for showing the output and progress of running
+# CLIs (cf. CLIExecution._showLiveStatus):
+LIVE_UPDATE_INTERVAL = 0.5
+
+# maximum time (in seconds) to wait for the end of the output after
+# the process terminated (it may have started children inheriting it):
+OUTPUT_EOF_TIMEOUT = 1.0
+
+# defaults of the fields in CLIModuleParameters.script that modules
+# generated by older versions of the importer lack (until re-imported):
+OPTIONAL_FIELD_DEFAULTS = dict(
+    useResultCache = False,
+    useMappedInputImages = False,
+    saveInputsInParallel = False,
+    streamInputImages = False,
+    debugOutputLimit = 1048576,
+    debugOutputWindow = 'Tail',
+    compressRetainedOutput = False,
+)
+
+def fieldValue(ctx, name):
+    """Return the value of the field `name` of the CLI module `ctx`,
+    falling back to OPTIONAL_FIELD_DEFAULTS if the module does not
+    have that field."""
+    if name in OPTIONAL_FIELD_DEFAULTS and not ctx.hasField(name):
+        return OPTIONAL_FIELD_DEFAULTS[name]
+    return ctx.field(name).value
+
+def setFieldValue(ctx, name, value):
+    """Set the field `name` of the CLI module `ctx`, if it has that
+    field (i.e. it is ignored for modules generated by older versions
+    of the importer)."""
+    if ctx.hasField(name):
+        ctx.field(name).value = value
+
+# number of voxels fetched at once by imageFingerprint():
+FINGERPRINT_CHUNK_VOXELS = 4 * 1024 * 1024
+
+def imageFingerprint(image, chunkVoxels = FINGERPRINT_CHUNK_VOXELS):
+    """Return tuple identifying the contents of the given (paged) image:
+    its extent, data type, voxel-to-world matrix, and a CRC-32 of all
+    voxels.  The voxels are fetched in slabs of about `chunkVoxels`
+    voxels, so that hashing does not need another copy of the whole
+    image in memory."""
+    extent = tuple(image.imageExtent())
+    sx, sy, sz, sc, st, su = extent
+    slabVoxels = max(1, sx * sy * sc * st * su)
+    slabDepth = max(1, chunkVoxels // slabVoxels)
+    crc = 0
+    for z in range(0, sz, slabDepth):
+        tile = image.getTile((0, 0, z, 0, 0, 0),
+                             (sx, sy, min(slabDepth, sz - z), sc, st, su))
+        crc = zlib.crc32(tile, crc)
+    matrix = tuple(tuple(row) for row in image.voxelToWorldMatrix())
+    return extent, str(image.dataType()), matrix, crc
+
+def fileFingerprint(path):
+    """Return JSON-serializable fingerprint of the given file or
+    directory (for the latter, a sorted list of the relative paths,
+    sizes and modification times of all files within), or None if it
+    does not exist."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if not os.path.isdir(path):
+        return (st.st_size, st.st_mtime_ns)
+    result = []
+    for directory, subDirectories, filenames in os.walk(path):
+        subDirectories.sort()
+        for filename in sorted(filenames):
+            fullPath = os.path.join(directory, filename)
+            try:
+                st = os.stat(fullPath)
+            except OSError:
+                continue # removed concurrently (or dangling symlink)
+            result.append((os.path.relpath(fullPath, path).replace(os.sep, '/'),
+                           st.st_size, st.st_mtime_ns))
+    return result
+
+# Uncompressed, single-file image formats supported by ITK (i.e. by most
+# CLI modules as well as by itkImageFileReader/Writer), cheapest first;
+# cf. benchmarks/image_format_benchmark.py.  (Two-file formats like
+# .mhd/.raw are avoided, since temporary files are handled one by one.)
+# Measured with SimpleITK 2.5 (Python 3.11, Linux, local disk; best
+# of three runs, write / read in seconds):
+#
+#   format      256^3 int16     512^3 int16     512^3 float32
+#   .nrrd       0.013 / 0.028   0.178 / 0.203   0.427 / 0.476
+#   .mha        0.019 / 0.031   0.172 / 0.183   0.509 / 0.397
+#   .nii        0.014 / 0.042   0.168 / 0.385   0.429 / 1.032
+#   .nrrd (gz)  0.748 / 0.239   6.076 / 2.158   13.94 / 3.504
+#   .nii.gz     0.905 / 0.054   7.692 / 0.449   20.21 / 1.128
+#
+# i.e. .nrrd and .mha are on par, .nii is slowest to read, and
+# compression multiplies the write time by 30-60 for saving only
+# 10-40% of the size.
+TEMPORARY_IMAGE_FORMATS = ('.nrrd', '.mha', '.nii')
+
+def temporaryImageExtension(parameter):
+    """Return filename extension for temporary files of the given
+    image parameter: the first of `TEMPORARY_IMAGE_FORMATS` that is
+    supported by the CLI module according to its fileExtensions,
+    falling back to the parameter's defaultExtension() (which may be
+    a compressed format like .nii.gz)."""
+    if not parameter.fileExtensions:
+        return TEMPORARY_IMAGE_FORMATS[0]
+    supported = [ext.lower() for ext in parameter.fileExtensions]
+    for ext in TEMPORARY_IMAGE_FORMATS:
+        if ext in supported:
+            return ext
+    return parameter.defaultExtension()
+
+def supportsMappedImages(parameter):
+    """Return whether the CLI module accepts MetaImage files (cf.
+    cli_mapped_images) for the given image parameter."""
+    return (not parameter.fileExtensions
+            or HEADER_EXTENSION in [ext.lower() for ext in parameter.fileExtensions])
+
+def imageFiles(filename):
+    """Return list of all files making up the given image file (i.e.
+    including the .raw file of .mhd headers)."""
+    if filename.endswith(HEADER_EXTENSION):
+        return [filename, dataFilename(filename)]
+    return [filename]
+
+class ArgumentConverter(object):
+    """Takes field values from ctx and formats the arguments for being
+    passed to CLI modules; manages list of temporary files in order to
+    be able to clean up afterwards.  The temporary files live in a
+    `cli_workspace.Workspace`, created on demand.
+    """
+
+    def __init__(self, ctx):
+        self._ctx = ctx
+        self._workspace = None
+        self._imageFilenames = {}
+        self._imageFingerprints = {}
+        self._currentFingerprints = {}
+        self._fields = {}
+        self._pins = 0
+        self._deferredRemovals = []
+
+    def _field(self, parameter):
+        # field objects live as long as the module, so look them up only once
+        result = self._fields.get(parameter)
+        if result is None:
+            result = self._fields[parameter] = self._ctx.field(fieldName(parameter))
+        return result
+
+    def pin(self):
+        """Prevent removal of the current temporary files (while other
+        modules still need them, cf. CLIExecution.attach) until
+        `unpin` is called; cleanup functions are still effective in
+        the sense that new temporary files will be used from now on."""
+        self._pins += 1
+
+    def unpin(self):
+        self._pins -= 1
+        if not self._pins:
+            removals, self._deferredRemovals = self._deferredRemovals, []
+            for path in removals:
+                self._remove(path)
+
+    def _remove(self, item):
+        if self._pins:
+            self._deferredRemovals.append(item)
+        elif isinstance(item, Workspace):
+            item.cleanup()
+        else:
+            for filename in imageFiles(item):
+                if self._workspace is not None:
+                    self._workspace.remove(filename)
+                elif os.path.exists(filename):
+                    os.unlink(filename)
+
+    @property
+    def workspace(self):
+        if self._workspace is None:
+            self._workspace = defaultManager().createWorkspace()
+        return self._workspace
+
+    def cleanupTemporaryFiles(self):
+        """Completely removes all temporary files."""
+        if self._workspace is not None:
+            self._remove(self._workspace)
+            self._workspace = None
+        self._imageFilenames = {}
+        self._imageFingerprints = {}
+        self._currentFingerprints = {}
+
+    def cleanupTemporaryFile(self, touchedFieldName):
+        """Remove a single temporary file for an image which was
+        touch()ed and thus cannot be reused.  Does nothing (in
+        particular, throws no error) if no entry for that field name
+        is found.
+        """
+        for p in self._imageFilenames:
+            if fieldName(p) == touchedFieldName:
+                self._forgetImage(p)
+                return
+
+    def _forgetImage(self, parameter):
+        # we need to correctly keep track of _imageFilenames, since
+        # inputImageFilenames() and outputImageFilenames() must not
+        # return old filenames:
+        filename = self._imageFilenames.pop(parameter, None)
+        if filename is not None:
+            self._remove(filename)
+        self._imageFingerprints.pop(parameter, None)
+        self._currentFingerprints.pop(parameter, None)
+
+    def mkstemp(self, suffix, evictable = False):
+        return self.workspace.mkstemp(suffix, evictable)
+
+    def scratchFile(self, name):
+        return self.workspace.scratchFile(name)
+
+    def inputImageFilenames(self):
+        for p, fn in self._imageFilenames.items():
+            if p.channel == 'input':
+                yield p, fn
+
+    def outputImageFilenames(self):
+        for p, fn in self._imageFilenames.items():
+            if p.channel == 'output':
+                yield p, fn
+
+    def renewOutputImageFilenames(self):
+        """Forget the temporary files of all output images, so that
+        each run writes new files instead of overwriting the previous
+        results in place (which attached executions may still be
+        copying, cf. `pin`)."""
+        for p in [p for p, fn in self.outputImageFilenames()]:
+            self._forgetImage(p)
+
+    def inputImageFingerprint(self, parameter):
+        """Return fingerprint (see `imageFingerprint`) of the current
+        image of the given input parameter.  It is only computed once
+        per image, i.e. until `inputImageTouched` is called."""
+        result = self._currentFingerprints.get(parameter)
+        if result is None:
+            result = self._currentFingerprints[parameter] = \
+                imageFingerprint(self._field(parameter).image())
+        return result
+
+    def inputImageTouched(self, touchedFieldName):
+        """Forget the fingerprint of the image of the given input field
+        (which was touched, i.e. its image changed)."""
+        for p in list(self._currentFingerprints):
+            if fieldName(p) == touchedFieldName:
+                del self._currentFingerprints[p]
+
+    def inputImageUpToDate(self, parameter, fingerprint):
+        """Return whether the temporary file for the given input
+        parameter already contains the image with the given
+        fingerprint (cf. `inputImageSaved`)."""
+        filename = self._imageFilenames[parameter]
+        return (self._imageFingerprints.get(parameter) == fingerprint
+                and all(os.path.exists(fn) and os.path.getsize(fn) > 0
+                        for fn in imageFiles(filename)))
+
+    def inputImageSaved(self, parameter, fingerprint):
+        self._imageFingerprints[parameter] = fingerprint
+
+    def inputImageFailed(self, parameter):
+        """Remove (possibly partially written) files of the given input
+        image parameter after saving it failed."""
+        self._imageFingerprints.pop(parameter, None)
+        for filename in imageFiles(self._imageFilenames[parameter]):
+            if os.path.exists(filename):
+                os.unlink(filename)
+
+    def inputImageExtension(self, parameter):
+        """Return filename extension for the temporary file of the
+        given input image parameter, i.e. .mhd if memory-mapped or
+        streamed input images are enabled and possible for the current
+        image."""
+        if ((fieldValue(self._ctx, 'useMappedInputImages')
+             or fieldValue(self._ctx, 'streamInputImages'))
+            and supportsMappedImages(parameter)
+            and canMapImage(self._field(parameter).image())):
+            return HEADER_EXTENSION
+        return temporaryImageExtension(parameter)
+
+    def parameterAvailable(self, parameter):
+        field = self._field(parameter)
+        if parameter.typ == 'image' and field.image():
+            return True
+        return False
+
+    def __call__(self, parameter):
+        field = self._field(parameter)
+        # TODO: do the following for all outputs that shall be automatically
+        # saved and loaded (but not for all external types, i.e. not if the field
+        # is a string filename field that is set by the user):
+        if parameter.typ == 'image':
+            # generate filenames
+            if parameter.channel == 'input' and not self.parameterAvailable(parameter):
+                # (optional) input image not given (anymore):
+                self._forgetImage(parameter)
+                return None
+            if parameter.channel == 'input':
+                extension = self.inputImageExtension(parameter)
+            else:
+                extension = temporaryImageExtension(parameter)
+            filename = self._imageFilenames.get(parameter)
+            if filename is not None and not filename.endswith(extension):
+                self._remove(filename) # exchange format changed
+                self._imageFingerprints.pop(parameter, None)
+                filename = None
+            if filename is None:
+                # (input images are saved again if evicted, cf.
+                # inputImageUpToDate)
+                fd, filename = self.mkstemp(extension,
+                                            evictable = parameter.channel == 'input')
+                os.close(fd)
+                self._imageFilenames[parameter] = filename
+            return filename
+        else:
+            if parameter.channel == 'output':
+                if parameter.default is None:
+                    return None # nothing to be passed into the CLI module
+            if parameter.isNumericVector():
+                return ",".join(field.stringValue().split())
+            elif parameter.typ == 'boolean':
+                if field.value:
+                    return True # just set the flag, don't pass an arg
+                else:
+                    return None # option not set -> no flag must be passed
+            elif parameter.typ == 'file' and not field.value:
+                return None # don't pass empty filenames
+            else:
+                return str(field.value)
+
+def escapeShellArg(s):
+    """Bad approximation, preventing stupid mistakes, but also
+    unconditional quoting.  (This is only used for *display* of the
+    command executed for copy-pasting, so no strict security is
+    required.)
+    """
+    for badChar in ' ;&|"\'':
+        if badChar in s:
+            return "'%s'" % s.replace("'", "'\"'\"'")
+    if not s:
+        return "''"
+    return s
+
+class CommandTemplate(object):
+    """Precompiled command line of a CLI module.  The parameters are
+    classified only once, and the converted arguments of non-image
+    input parameters (whose fields are all monitored by the autoApply
+    FieldListener, cf. cli_to_macro.mdlDescription) are cached until
+    their field is reported as changed via `markDirty`.  Image and
+    output parameters are converted anew for every run, since their
+    arguments depend on state that is not tracked by field listeners
+    (e.g. temporary files, or return parameters)."""
+
+    def __init__(self, cliModule):
+        arguments, options, outputs = cliModule.classifyParameters()
+        self.arguments = arguments
+        self.hasOutputs = bool(outputs)
+        self._options = [
+            (p, p.longflag if p.longflag is not None else p.flag,
+             fieldName(p) if p.typ != 'image' and p.channel != 'output' else None)
+            for p in options]
+        self._cache = {} # field name -> converted argument
+
+        # parameters referring to files that are not managed by us:
+        self.fileParameters = [
+            p for p in cliModule.parameters()
+            if p.typ != 'image' and (p.typ in ('file', 'directory') or p.isExternalType())]
+
+    def markDirty(self, fieldName):
+        """Drop cached argument of the parameter with the given field
+        name (if any)."""
+        self._cache.pop(fieldName, None)
+
+    def options(self, arg):
+        """Return list of command line options (flags and values),
+        using the ArgumentConverter `arg` for parameters that are
+        not cached."""
+        result = []
+        cache = self._cache
+        for p, flag, cacheKey in self._options:
+            if cacheKey is None:
+                value = arg(p)
+            else:
+                try:
+                    value = cache[cacheKey]
+                except KeyError:
+                    value = cache[cacheKey] = arg(p)
+            if value is None: # missing optional arg / output arg (without default) / false bool
+                continue
+            result.append(flag)
+            # boolean is special cased, because we need to decide
+            # about passing --longflag without arg:
+            if value != True:
+                result.append(value)
+        return result
+
+class CLIExecution(object):
+    """A single run of the CLI executable of the given `backend`."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.returnParameterFilename = None
+
+        self.stdoutCapture = None
+        self.stderrCapture = None
+        self.progressParser = None
+        self.startTime = None
+        self.process = None
+        self.notifier = None
+        self.errorDescription = None
+        self.resultKey = None
+        self.storeResult = False
+        self.leader = None # execution we are attached to (cf. attach())
+        self.streams = [] # (voxels, rawFilename) tuples, cf. saveInputImages()
+        self.streamers = []
+        self.streamingFailed = False
+        self.workspace = None # (set while our process is running)
+        self._finished = False
+
+        # results, collected by collectResults():
+        self.outputFilenames = {}
+        self.stdoutText = None
+        self.stderrText = None
+        self.returnParameters = {}
+
+    def compileCommand(self):
+        cliModule, arg = self.backend.cliModule, self.backend.arg
+        template = self.backend.commandTemplate
+
+        command = [cliModule.path]
+        command.extend(template.options(arg))
+
+        if template.hasOutputs:
+            command.append('--returnparameterfile')
+            fd, self.returnParameterFilename = arg.scratchFile('returnparameters.params')
+            os.close(fd)
+            command.append(self.returnParameterFilename)
+
+        for p in template.arguments:
+            value = arg(p)
+            if value is None:
+                self.backend.clear()
+                return "%s: Input image %r is not optional!\n" % (cliModule.name, fieldName(p))
+            command.append(value)
+
+        return command
+
+    def inputFingerprints(self):
+        """Return dict mapping input image parameters to fingerprints
+        of their current images."""
+        arg = self.backend.arg
+        return dict((p, arg.inputImageFingerprint(p))
+                    for p, filename in arg.inputImageFilenames())
+
+    def saveInputImages(self, fingerprints):
+        """Save the input images that changed since they were last
+        saved.  If saveInputsInParallel is set, memory-mapped inputs
+        (cf. cli_mapped_images) are fetched slab by slab on the main
+        thread (since ML images must not be accessed from other
+        threads), but written by `savePool` while the next slabs and
+        the remaining inputs are fetched / saved.
+        The time needed for each input is shown in debugSaveTimes.
+
+        If streamInputImages is set, memory-mapped inputs are not
+        written at all, but their .raw files are named pipes into which
+        the voxels are streamed while the CLI is running (see `start`);
+        CLIs that fail to read them (e.g. because they seek) are
+        remembered and get regular files from then on.
+
+        If saving any input fails, its files are removed, and the
+        first error is raised after all writes finished."""
+        ctx = self.backend.ctx
+        arg = self.backend.arg
+        parallel = fieldValue(ctx, 'saveInputsInParallel')
+        stream = (fieldValue(ctx, 'streamInputImages') and canStreamImages()
+                  and self.backend.cliModule.path not in _requiresRegularFiles)
+        report = []
+        pending = []
+        error = None
+        for p, filename in list(arg.inputImageFilenames()):
+            for fn in imageFiles(filename):
+                arg.workspace.touch(fn)
+            # upstream notifications do not necessarily mean that the
+            # voxels changed, so compare fingerprints before saving:
+            if arg.inputImageUpToDate(p, fingerprints[p]):
+                report.append('%s: unchanged' % fieldName(p))
+                continue
+            start = time.perf_counter()
+            try:
+                if filename.endswith(HEADER_EXTENSION):
+                    image = ctx.field(fieldName(p)).image()
+                    if stream:
+                        voxels, voxelToWorldMatrix = fetchImage(image)
+                        rawFilename = createStreamedImage(voxels, voxelToWorldMatrix, filename)
+                        arg.workspace.addFile(rawFilename)
+                        self.streams.append((voxels, rawFilename))
+                        report.append('%s: streamed (fetch %.3fs)' % (
+                            fieldName(p), time.perf_counter() - start))
+                        continue
+                    if parallel:
+                        future = writeMappedImageInBackground(image, filename, savePool())
+                        pending.append((p, time.perf_counter() - start, future))
+                        continue
+                    arg.workspace.addFile(writeMappedImage(image, filename), evictable = True)
+                else:
+                    ioModule = ctx.module(fieldName(p))
+                    ioModule.field('unresolvedFileName').value = filename
+                    if ioModule.hasField('useCompression'):
+                        # compression costs much more time than it saves I/O:
+                        ioModule.field('useCompression').value = False
+                    ioModule.field('save').touch()
+            except Exception as e:
+                arg.inputImageFailed(p)
+                report.append('%s: FAILED (%s)' % (fieldName(p), e))
+                error = error or e
+                continue
+            arg.inputImageSaved(p, fingerprints[p])
+            report.append('%s: %.3fs' % (fieldName(p), time.perf_counter() - start))
+
+        for p, fetchTime, future in pending:
+            try:
+                rawFilename, writeTime = future.result()
+            except Exception as e:
+                arg.inputImageFailed(p)
+                report.append('%s: FAILED (%s)' % (fieldName(p), e))
+                error = error or e
+                continue
+            arg.workspace.addFile(rawFilename, evictable = True)
+            arg.inputImageSaved(p, fingerprints[p])
+            report.append('%s: fetch %.3fs, write %.3fs (overlapping, in parallel)' % (
+                fieldName(p), fetchTime, writeTime))
+
+        setFieldValue(ctx, 'debugSaveTimes', '\n'.join(report))
+        if error is not None:
+            raise error
+
+    def computeResultKey(self, command, inputFingerprints):
+        """Return key for the result cache (see `resultCache`), or
+        None if the results of this run cannot be cached, i.e. if it
+        writes to files that are not managed by us."""
+        arg = self.backend.arg
+        # temporary filenames differ between runs / instances:
+        placeholders = {self.returnParameterFilename : '<returnparameterfile>'}
+        for p, filename in arg.inputImageFilenames():
+            placeholders[filename] = '<%s>' % fieldName(p)
+        for p, filename in arg.outputImageFilenames():
+            placeholders[filename] = '<%s>' % fieldName(p)
+
+        inputFiles = {}
+        for p in self.backend.commandTemplate.fileParameters:
+            path = arg(p)
+            if path is None:
+                continue
+            if p.channel == 'output':
+                return None
+            inputFiles[fieldName(p)] = fileFingerprint(path)
+
+        return CLIResultCache.key(
+            executableFingerprint(self.backend.cliModule.path),
+            [placeholders.get(a, a) for a in command],
+            sorted((fieldName(p), fingerprint) for p, fingerprint in inputFingerprints.items()),
+            inputFiles)
+
+    def useCachedResult(self):
+        """Populate outputs from the result cache entry for
+        `resultKey`; returns False if there is no (complete) entry."""
+        result = resultCache().get(self.resultKey)
+        if result is None:
+            return False
+        try:
+            for p, filename in self.backend.arg.outputImageFilenames():
+                linkOrCopyFile(result['outputs'][fieldName(p)], filename)
+        except (OSError, KeyError):
+            return False # (e.g. evicted concurrently)
+        self._finished = True
+        ctx = self.backend.ctx
+        self.setProgress(1.0, '', 0.0, 0.0)
+        ctx.field('debugStdOut').value = result['stdout']
+        ctx.field('debugStdErr').value = result['stderr']
+        self.setReturnParameters(result['returnParameters'])
+        self.loadOutputImages()
+        return True
+
+    def attach(self, leader):
+        """Instead of starting an identical process, wait for the
+        running execution `leader` and copy its results.  The leader's
+        temporary files are pinned until we have copied them, so that
+        they survive a cleanup by the leader's module."""
+        self.leader = leader
+        leader.backend.arg.pin()
+
+    def detach(self):
+        if self.leader is not None:
+            self.leader.backend.arg.unpin()
+            self.leader = None
+
+    def start(self):
+        arg = self.backend.arg
+        ctx = self.backend.ctx
+        self.setProgress(0.0, '', 0.0, None)
+        arg.renewOutputImageFilenames()
+        command = self.compileCommand()
+        ctx.field('debugCommandline').value = ' '.join(map(escapeShellArg, command))
+
+        inputFingerprints = self.inputFingerprints()
+        self.resultKey = self.computeResultKey(command, inputFingerprints)
+        if self.resultKey is not None:
+            self.storeResult = fieldValue(ctx, 'useResultCache')
+            if self.storeResult and self.useCachedResult():
+                return None # no process needed
+            leader = _inFlight.get(self.resultKey)
+            if leader is not None and leader.isRunning():
+                self.attach(leader)
+                return None
+
+        self.errorDescription = None
+        try:
+            self.saveInputImages(inputFingerprints)
+        except Exception as e:
+            self.backend.clear()
+            self.errorDescription = "%s: could not save input images (%s)!\n" % (
+                self.backend.cliModule.name, e)
+            return None
+        self.outputFilenames = dict((fieldName(p), filename)
+                                    for p, filename in arg.outputImageFilenames())
+        stdout, self.stdoutCapture = self._captureOutput('stdout.txt')
+        stderr, self.stderrCapture = self._captureOutput('stderr.txt')
+        self.progressParser = ProgressParser()
+        self.stdoutCapture.addListener(self.progressParser.feed)
+        self.workspace = arg.workspace
+        self.workspace.busy = True
+        try:
+            self.process = popenCLIExecutable(command, stdout = stdout, stderr = stderr,
+                                              env = mlabFreeEnvironment())
+        finally:
+            os.close(stdout)
+            os.close(stderr)
+        self.startTime = time.perf_counter()
+        self.stdoutCapture.start()
+        self.stderrCapture.start()
+        for voxels, rawFilename in self.streams:
+            streamer = ImageStreamer(voxels, rawFilename, self.process)
+            streamer.start()
+            self.streamers.append(streamer)
+        self.streams = []
+        self.notifier = CompletionNotifier(self.process)
+        if self.resultKey is not None:
+            _inFlight[self.resultKey] = self
+        self._showLiveStatus()
+        return self.process
+
+    def _captureOutput(self, name):
+        """Return (fd, capture) tuple with the write end of a new pipe
+        for the CLI, and the OutputCapture reading from it, configured
+        by the fields of our module.  If temporary files are retained,
+        the full output is spilled to the workspace file `name`."""
+        ctx = self.backend.ctx
+        readFd, writeFd = os.pipe()
+        spillFilename = None
+        compress = fieldValue(ctx, 'compressRetainedOutput')
+        if ctx.field('retainTemporaryFiles').value:
+            fd, spillFilename = self.backend.arg.scratchFile(name + ('.gz' if compress else ''))
+            os.close(fd)
+        limit = fieldValue(ctx, 'debugOutputLimit')
+        capture = OutputCapture(readFd, limit if limit > 0 else None,
+                                fieldValue(ctx, 'debugOutputWindow'),
+                                spillFilename, compress)
+        return writeFd, capture
+
+    def _showLiveStatus(self, versions = (None, None)):
+        """Show the output captured so far in the debug fields, and the
+        progress parsed from it in the progress fields while the
+        process is running (re-scheduling itself, i.e. throttled to
+        one update every LIVE_UPDATE_INTERVAL seconds)."""
+        stdoutCapture, stderrCapture = self.stdoutCapture, self.stderrCapture
+        if stdoutCapture is None:
+            return # results collected
+        ctx = self.backend.ctx
+        if stdoutCapture.version != versions[0]:
+            ctx.field('debugStdOut').value = stdoutCapture.text()
+        if stderrCapture.version != versions[1]:
+            ctx.field('debugStdErr').value = stderrCapture.text()
+        versions = (stdoutCapture.version, stderrCapture.version)
+
+        parser = self.progressParser
+        elapsed = time.perf_counter() - self.startTime
+        fraction = parser.fraction()
+        self.setProgress(fraction or 0.0, parser.stage or parser.comment, elapsed,
+                         estimateRemainingTime(elapsed, fraction))
+
+        ctx.callLater(LIVE_UPDATE_INTERVAL, lambda: self._showLiveStatus(versions))
+
+    def setProgress(self, fraction, stage, elapsed, remaining):
+        """Set progress fields (only those whose value changed);
+        `remaining` may be None if unknown."""
+        ctx = self.backend.ctx
+        for name, value in (('progress', fraction),
+                            ('progressStage', stage),
+                            ('progressElapsed', elapsed),
+                            ('progressETA', -1.0 if remaining is None else remaining)):
+            if not ctx.hasField(name):
+                continue # (module generated by an older importer)
+            field = ctx.field(name)
+            if field.value != value:
+                field.value = value
+
+    def isRunning(self):
+        if self.leader is not None:
+            return self.leader.isRunning()
+        if self.process is None:
+            return False # result was taken from cache
+        return not self.notifier.isTerminated()
+
+    def completion(self):
+        """Return the CompletionNotifier of the process whose results
+        we are waiting for, or None if there is no process."""
+        if self.leader is not None:
+            return self.leader.completion()
+        return self.notifier
+
+    def wait(self):
+        if self.leader is not None:
+            return self._waitForLeader()
+        if self.process is None:
+            # (result was taken from cache, or saving inputs failed)
+            return 1 if self.errorDescription else 0
+        if self.isRunning():
+            self.process.wait()
+        ec = self.process.returncode
+        if not self._finished: # wait() may be called again
+            self._finished = True
+            for streamer in self.streamers:
+                streamer.join()
+            if ec and any(isinstance(streamer.error, BrokenPipeError)
+                          for streamer in self.streamers):
+                # the CLI stopped reading early (e.g. in order to seek),
+                # so fall back to regular files (see tryUpdate); not if
+                # it never opened the pipe (e.g. due to bad arguments):
+                _requiresRegularFiles.add(self.backend.cliModule.path)
+                self.streamingFailed = True
+            self.streamers = []
+            self._processTerminated(ec)
+        return ec
+
+    def collectResults(self):
+        """Read standard output / error and return parameters of the
+        terminated process (only once; independent of our module's
+        state, since attached executions call this, too)."""
+        if self.stdoutCapture is None:
+            return
+        stdoutCapture, stderrCapture = self.stdoutCapture, self.stderrCapture
+        self.stdoutCapture = None
+        self.stderrCapture = None
+        if _inFlight.get(self.resultKey) is self:
+            del _inFlight[self.resultKey]
+        self.workspace.busy = False
+
+        stdoutCapture.join(OUTPUT_EOF_TIMEOUT)
+        stderrCapture.join(OUTPUT_EOF_TIMEOUT)
+        self.stdoutText = stdoutCapture.text()
+        self.stderrText = stderrCapture.text()
+        if self.process.returncode == 0:
+            self.returnParameters = self.parseResults()
+
+    def _processTerminated(self, ec):
+        ctx = self.backend.ctx
+        self.collectResults()
+
+        ctx.field('debugStdOut').value = self.stdoutText
+        ctx.field('debugStdErr').value = self.stderrText
+
+        parser = self.progressParser
+        elapsed = time.perf_counter() - self.startTime
+        if ec == 0:
+            self.setProgress(1.0, parser.stage or parser.comment, elapsed, 0.0)
+            self.setReturnParameters(self.returnParameters)
+            self.loadOutputImages()
+            if self.storeResult:
+                resultCache().put(self.resultKey, self.outputFilenames,
+                                  self.returnParameters, self.stdoutText, self.stderrText)
+        else:
+            self.setProgress(parser.fraction() or 0.0, parser.stage or parser.comment,
+                             elapsed, None)
+            self._failed(ec)
+
+        self.workspace.enforceQuotas()
+        return ec
+
+    def _waitForLeader(self):
+        leader = self.leader
+        try:
+            if leader.isRunning():
+                leader.process.wait()
+            ec = leader.process.returncode
+            leader.collectResults()
+            if not self._finished:
+                self._finished = True
+                ctx = self.backend.ctx
+                ctx.field('debugStdOut').value = leader.stdoutText
+                ctx.field('debugStdErr').value = leader.stderrText
+                if ec == 0:
+                    self.setProgress(1.0, '', time.perf_counter() - leader.startTime, 0.0)
+                    for p, filename in self.backend.arg.outputImageFilenames():
+                        linkOrCopyFile(leader.outputFilenames[fieldName(p)], filename)
+                    self.setReturnParameters(leader.returnParameters)
+                    self.loadOutputImages()
+                else:
+                    self._failed(ec)
+        finally:
+            self.detach()
+        return ec
+
+    def _failed(self, ec):
+        self.backend.clear()
+        name = self.backend.cliModule.name
+        if ec > 0:
+            self.errorDescription = "%s returned exitcode %d!\n" % (name, ec)
+        else:
+            self.errorDescription = "%s received SIGNAL %d!\n" % (name, -ec)
+
+    def parseResults(self):
+        """Return dict of the values from the return parameter file."""
+        result = {}
+        if self.returnParameterFilename:
+            with open(self.returnParameterFilename) as f:
+                for line in f:
+                    key, value = line.split('=', 1)
+                    result[key.strip()] = value.strip()
+        return result
+
+    def setReturnParameters(self, returnParameters):
+        for key, value in returnParameters.items():
+            self.backend.ctx.field(key).value = value
+
+    def loadOutputImages(self):
+        ctx = self.backend.ctx
+        for p, filename in self.backend.arg.outputImageFilenames():
+            ioModule = ctx.module(fieldName(p))
+            ioModule.field('unresolvedFileName').value = filename
+
+class CLIModuleBackend(object):
+    """Per-instance state and commands of a generated CLI macro module
+    (whose ctx is passed to the constructor)."""
+
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.cliModule = None
+        self.commandTemplate = None
+        self.arg = ArgumentConverter(ctx)
+        self.execution = None
+
+    def checkCLI(self):
+        executablePath = self.ctx.field('cliExecutablePath').value
+        # use the description embedded by the importer (next to our .script)
+        # instead of running the executable with --xml:
+        self.cliModule = loadEmbeddedCLIModule(
+            executablePath,
+            os.path.join(self.ctx.localPath(), cliModuleName(executablePath) + DESCRIPTION_SUFFIX),
+            env = mlabFreeEnvironment())
+        self.commandTemplate = CommandTemplate(self.cliModule)
+
+    def updateIfAutoApply(self, field = None):
+        if field is not None:
+            self.commandTemplate.markDirty(field.getName())
+        if self.ctx.field("autoApply").value:
+            self.update()
+        else:
+            self.clear()
+
+    def updateIfAutoUpdate(self, field):
+        # (the temporary file of the touched input is kept, cf.
+        # CLIExecution.saveInputImages, but its fingerprint is outdated)
+        self.arg.inputImageTouched(field.getName())
+        if self.ctx.field("autoUpdate").value:
+            self.tryUpdate()
+        else:
+            self.clear()
+
+    def cleanupTemporaryFiles(self):
+        if self.execution is not None:
+            self.execution.detach() # don't keep another module's files alive
+        if not self.ctx.field('retainTemporaryFiles').value:
+            self.arg.cleanupTemporaryFiles()
+
+    def _pollProcessStatus(self, completion):
+        # (only needed if the notifier is not event-driven, i.e. without Qt)
+        if not completion.poll():
+            self.ctx.callLater(0.15, lambda: self._pollProcessStatus(completion))
+
+    def _executionTerminated(self, execution):
+        ec = execution.wait()
+        if ec and execution.streamingFailed and execution is self.execution:
+            self.tryUpdate() # (now with regular files)
+
+    def tryUpdate(self):
+        """Execute the CLI module, but don't warn about missing inputs (used
+        for autoUpdate).  Returns error messages that can be displayed if
+        explicitly run (cf. update())."""
+
+        self.execution = CLIExecution(self)
+
+        execution = self.execution
+        execution.start()
+        completion = execution.completion()
+        if self.ctx.field('runInBackground_WIP').value:
+            if completion is None:
+                self._executionTerminated(execution)
+            else:
+                completion.whenTerminated(lambda: self._executionTerminated(execution))
+                if not completion.eventDriven:
+                    self._pollProcessStatus(completion)
+        else:
+            if completion is not None:
+                completion.waitProcessingEvents(MLAB.processEvents)
+            ec = self.execution.wait()
+            if ec and self.execution.streamingFailed:
+                return self.tryUpdate() # (now with regular files)
+            if ec:
+                return self.execution.errorDescription
+
+    def update(self):
+        """Execute the CLI module"""
+        failReason = self.tryUpdate()
+        if failReason:
+            sys.stderr.write(failReason)
+
+    def clear(self):
+        """Close all itkImageFileReaders such as to make the output image states invalid"""
+        for o in self.ctx.outputs():
+            self.ctx.module(o).field("close").touch()
+            self.arg.cleanupTemporaryFile(o)
+
+def test_disconnected_input_image():
+    class Parameter(object):
+        typ, channel, fileExtensions = 'image', 'input', ['.nrrd']
+        def identifier(self):
+            return 'inputVolume'
+    class Field(object):
+        def __init__(self, value):
+            self.value = value
+        def image(self):
+            return self.value
+    class Context(object):
+        def __init__(self):
+            # (no useMappedInputImages etc., like modules generated
+            # by older versions of the importer)
+            self.fields = dict(inputVolume = Field(object()))
+        def hasField(self, name):
+            return name in self.fields
+        def field(self, name):
+            return self.fields[name]
+
+    ctx = Context()
+    arg = ArgumentConverter(ctx)
+    p = Parameter()
+    try:
+        filename = arg(p)
+        assert list(arg.inputImageFilenames()) == [(p, filename)]
+        arg.inputImageSaved(p, 'fingerprint')
+        ctx.fields['inputVolume'].value = None # disconnect optional input
+        assert arg(p) is None
+        assert list(arg.inputImageFilenames()) == []
+        assert not os.path.exists(filename)
+    finally:
+        arg.cleanupTemporaryFiles()
+
+def test_cached_input_fingerprint():
+    class Parameter(object):
+        typ, channel, fileExtensions = 'image', 'input', ['.nrrd']
+        def identifier(self):
+            return 'inputVolume'
+    class Image(object):
+        tiles = 0
+        def imageExtent(self):
+            return (2, 2, 1, 1, 1, 1)
+        def getTile(self, position, size):
+            Image.tiles += 1
+            return b'voxels'
+        def voxelToWorldMatrix(self):
+            return [[1, 0, 0, 0], [0, 1, 0, 0], [0, 0, 1, 0], [0, 0, 0, 1]]
+        def dataType(self):
+            return 'int8'
+    class Field(object):
+        def image(self):
+            return Image()
+    class Context(object):
+        def field(self, name):
+            return Field()
+
+    arg = ArgumentConverter(Context())
+    p = Parameter()
+    fingerprint = arg.inputImageFingerprint(p)
+    assert arg.inputImageFingerprint(p) == fingerprint and Image.tiles == 1
+    arg.inputImageTouched('otherInput')
+    assert arg.inputImageFingerprint(p) == fingerprint and Image.tiles == 1
+    arg.inputImageTouched('inputVolume')
+    assert arg.inputImageFingerprint(p) == fingerprint and Image.tiles == 2
+
+def test_fresh_output_files():
+    class Parameter(object):
+        typ, channel, fileExtensions = 'image', 'output', ['.nrrd']
+        def identifier(self):
+            return 'outputVolume'
+    class Context(object):
+        def field(self, name):
+            return None
+
+    arg = ArgumentConverter(Context())
+    p = Parameter()
+    try:
+        first = arg(p)
+        assert arg(p) == first
+        arg.pin() # (an attached execution still reads the outputs)
+        arg.renewOutputImageFilenames()
+        second = arg(p)
+        assert second != first and os.path.exists(first)
+        arg.unpin()
+        assert not os.path.exists(first)
+        assert list(arg.outputImageFilenames()) == [(p, second)]
+    finally:
+        arg.cleanupTemporaryFiles()
+
+def test_directory_fingerprint():
+    import tempfile
+    directory = tempfile.mkdtemp()
+    try:
+        os.mkdir(os.path.join(directory, 'series'))
+        filename = os.path.join(directory, 'series', 'slice1.dcm')
+        with open(filename, 'wb') as f:
+            f.write(b'0000')
+        fingerprint = fileFingerprint(directory)
+        assert [entry[:2] for entry in fingerprint] == [('series/slice1.dcm', 4)]
+        # changes within subdirectories do not change the directory's mtime:
+        with open(filename, 'ab') as f:
+            f.write(b'1')
+        assert fileFingerprint(directory) != fingerprint
+        assert fileFingerprint(filename)[0] == 5
+        assert fileFingerprint(os.path.join(directory, 'missing')) is None
+    finally:
+        shutil.rmtree(directory)
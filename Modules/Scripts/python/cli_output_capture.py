@@ -0,0 +1,147 @@
+# Copyright (c) Fraunhofer MEVIS, Germany. All rights reserved.
+# **InsertLicense** code
+"""Incremental capture of the standard output / error of CLI processes.
+
+An `OutputCapture` thread reads a pipe while the process is running
+and keeps only a bounded window of it in memory: either the first or
+the last `limit` bytes (see `HEAD` / `TAIL`).  Optionally, the full
+output is spilled to a (possibly gzip-compressed) file, and listeners
+can process every chunk as it arrives (cf. cli_progress).
+"""
+
+import os, gzip, threading, collections
+
+HEAD = 'Head'
+TAIL = 'Tail'
+
+DEFAULT_LIMIT = 1024 * 1024
+
+READ_BYTES = 64 * 1024
+
+class OutputCapture(threading.Thread):
+    """Reads the file descriptor `fd` (e.g. a pipe) until EOF, and
+    closes it.  `text()` returns the retained window, which may be
+    called from other threads at any time.  `limit` of None means
+    unlimited.  If `spillFilename` is given, all data is also written
+    to that file (gzip-compressed if `compress` is set)."""
+
+    def __init__(self, fd, limit = DEFAULT_LIMIT, window = TAIL,
+                 spillFilename = None, compress = False):
+        threading.Thread.__init__(self, name = 'CLIOutputCapture', daemon = True)
+        self.fd = fd
+        self.limit = limit
+        self.window = window
+        self.spillFilename = spillFilename
+        self.compress = compress
+        self.totalBytes = 0
+        self.version = 0 # incremented whenever text() changes
+        self._chunks = collections.deque()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._listeners = []
+
+    def addListener(self, listener):
+        """Register `listener` to be called with every chunk of bytes
+        read (from the capture thread!); must be called before
+        `start`."""
+        self._listeners.append(listener)
+
+    def _append(self, chunk):
+        with self._lock:
+            self.totalBytes += len(chunk)
+            if self.limit is None:
+                self._chunks.append(chunk)
+                self._size += len(chunk)
+            elif self.window == HEAD:
+                if self._size >= self.limit:
+                    return
+                chunk = chunk[:self.limit - self._size]
+                self._chunks.append(chunk)
+                self._size += len(chunk)
+            else:
+                self._chunks.append(chunk)
+                self._size += len(chunk)
+                while self._size > self.limit:
+                    excess = self._size - self.limit
+                    first = self._chunks[0]
+                    if len(first) <= excess:
+                        self._chunks.popleft()
+                        self._size -= len(first)
+                    else:
+                        self._chunks[0] = first[excess:]
+                        self._size -= excess
+            self.version += 1
+
+    def run(self):
+        spill = None
+        try:
+            if self.spillFilename is not None:
+                spill = (gzip.open if self.compress else open)(self.spillFilename, 'wb')
+            while True:
+                chunk = os.read(self.fd, READ_BYTES)
+                if not chunk:
+                    break
+                self._append(chunk)
+                if spill is not None:
+                    spill.write(chunk)
+                for listener in self._listeners:
+                    listener(chunk)
+        finally:
+            os.close(self.fd)
+            if spill is not None:
+                spill.close()
+
+    def text(self):
+        """Return retained window as string, with a note about the
+        number of omitted bytes (if any)."""
+        with self._lock:
+            data = b''.join(self._chunks)
+            omitted = self.totalBytes - len(data)
+        result = data.decode('utf-8', 'replace')
+        if omitted:
+            note = '[... %d bytes omitted ...]' % omitted
+            if self.window == HEAD:
+                result = result + '\n' + note
+            else:
+                result = note + '\n' + result
+        return result
+
+def _capture(chunks, **kwargs):
+    readFd, writeFd = os.pipe()
+    capture = OutputCapture(readFd, **kwargs)
+    received = []
+    capture.addListener(received.append)
+    capture.start()
+    for chunk in chunks:
+        os.write(writeFd, chunk)
+    os.close(writeFd)
+    capture.join()
+    assert b''.join(received) == b''.join(chunks)
+    return capture
+
+def test_tail_window():
+    capture = _capture([b'first\n', b'second\n', b'third\n'], limit = 10)
+    assert capture.totalBytes == 19
+    assert capture.text() == '[... 9 bytes omitted ...]\nond\nthird\n'
+
+def test_head_window():
+    capture = _capture([b'first\n', b'second\n', b'third\n'], limit = 10, window = HEAD)
+    assert capture.text() == 'first\nseco\n[... 9 bytes omitted ...]'
+
+def test_unlimited():
+    capture = _capture([b'x' * READ_BYTES] * 3, limit = None)
+    assert capture.text() == 'x' * (3 * READ_BYTES)
+    assert _capture([], limit = 10).text() == ''
+
+def test_spill():
+    import tempfile, shutil
+    directory = tempfile.mkdtemp()
+    try:
+        for compress in (False, True):
+            spillFilename = os.path.join(directory, 'stdout.txt')
+            _capture([b'a' * 100, b'b' * 100], limit = 10, spillFilename = spillFilename,
+                     compress = compress)
+            with (gzip.open if compress else open)(spillFilename, 'rb') as f:
+                assert f.read() == b'a' * 100 + b'b' * 100
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,171 @@
+# Copyright (c) Fraunhofer MEVIS, Germany. All rights reserved.
+# **InsertLicense** code
+"""Optional instrumentation of CLI imports (see
+`cli_to_macro.importAllCLIs`), recording wall time, CPU time and peak
+memory of the phases of processing each module:
+
+cache
+  looking up the XML description in a `cli_cache.CLIDescriptionCache`
+extract
+  running the executable with --xml (on posix systems, the 'cpu'
+  time includes the CPU time of the executable)
+parse
+  parsing the XML into a CLIModule (via ctk_cli)
+describe
+  building the MDL trees (`cli_to_macro.mdlDescription`)
+write
+  writing the generated files
+"""
+
+import os, json, time, threading, tracemalloc
+
+PHASES = ('cache', 'extract', 'parse', 'describe', 'write')
+
+# name of the report written by importAllCLIs into the target directory:
+REPORT_FILENAME = 'importProfile.json'
+
+
+class _Phase(object):
+    def __init__(self, profile, name):
+        self._profile = profile
+        self._name = name
+
+    def __enter__(self):
+        self._traceMemory = tracemalloc.is_tracing()
+        if self._traceMemory:
+            self._startMemory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        self._startCPU = time.thread_time()
+        self._startWall = time.perf_counter()
+
+    def __exit__(self, *excInfo):
+        result = dict(wall = time.perf_counter() - self._startWall,
+                      cpu = time.thread_time() - self._startCPU)
+        if self._traceMemory:
+            result['peakMemory'] = tracemalloc.get_traced_memory()[1] - self._startMemory
+        self._profile.phases[self._name] = result
+
+
+class ModuleProfile(object):
+    """Timings of the phases (see `PHASES`) of importing the CLI
+    module `path`.  `phases` maps phase names to dicts with 'wall' and
+    'cpu' seconds and (if memory is traced, see `ImportProfile`) the
+    'peakMemory' in bytes allocated during that phase.  CPU time is
+    measured per thread, so it is also correct for phases executed by
+    worker threads.  Phases running child processes may additionally
+    report their 'childCPU' seconds (see `addChildCPU`), which are
+    included in 'cpu'."""
+
+    def __init__(self, path):
+        self.path = path
+        self.phases = {}
+
+    def phase(self, name):
+        """Return context manager measuring the phase `name`."""
+        return _Phase(self, name)
+
+    def addChildCPU(self, name, seconds):
+        """Add the CPU time of a child process run during the
+        (finished) phase `name`."""
+        phase = self.phases[name]
+        phase['childCPU'] = phase.get('childCPU', 0.0) + seconds
+        phase['cpu'] += seconds
+
+    def total(self, key = 'wall'):
+        return sum(phase[key] for phase in self.phases.values())
+
+    def asDict(self):
+        return dict(path = self.path, phases = self.phases,
+                    wall = self.total('wall'), cpu = self.total('cpu'))
+
+    def __str__(self):
+        return "%.3fs %s (%s)" % (
+            self.total(), os.path.basename(self.path), ", ".join(
+                "%s %.3fs" % (name, self.phases[name]['wall'])
+                for name in PHASES if name in self.phases))
+
+
+class _NoProfile(object):
+    """Null object used instead of a ModuleProfile if profiling is
+    disabled."""
+    class _NoPhase(object):
+        def __enter__(self):
+            pass
+        def __exit__(self, *excInfo):
+            pass
+
+    _noPhase = _NoPhase()
+
+    def phase(self, name):
+        return self._noPhase
+
+    def addChildCPU(self, name, seconds):
+        pass
+
+NO_PROFILE = _NoProfile()
+
+
+class ImportProfile(object):
+    """Collects ModuleProfile instances of a whole import.  If
+    `traceMemory` is set, the tracemalloc module is used to measure
+    peak memory per phase (which slows down Python code considerably,
+    and is only approximate when multiple jobs run in parallel)."""
+
+    def __init__(self, traceMemory = False):
+        self.traceMemory = traceMemory
+        self.modules = []
+        self.wall = None
+        self._lock = threading.Lock()
+        self._startedTracing = False
+
+    def start(self):
+        self._startWall = time.perf_counter()
+        if self.traceMemory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._startedTracing = True
+
+    def stop(self):
+        self.wall = time.perf_counter() - self._startWall
+        if self._startedTracing:
+            tracemalloc.stop()
+            self._startedTracing = False
+
+    def moduleProfile(self, path):
+        """Return new ModuleProfile for `path` (and remember it)."""
+        result = ModuleProfile(path)
+        with self._lock:
+            self.modules.append(result)
+        return result
+
+    def slowest(self, count = 10, key = 'wall'):
+        return sorted(self.modules, key = lambda m: m.total(key), reverse = True)[:count]
+
+    def phaseTotals(self, key = 'wall'):
+        result = dict.fromkeys(PHASES, 0.0)
+        for m in self.modules:
+            for name, phase in m.phases.items():
+                result[name] += phase[key]
+        return result
+
+    def summary(self, count = 10):
+        """Return human-readable summary (phase totals and slowest
+        modules) as string."""
+        lines = ["Import of %d modules took %.3fs; total time per phase: %s" % (
+            len(self.modules), self.wall or 0.0, ", ".join(
+                "%s %.3fs" % item for item in sorted(
+                    self.phaseTotals().items(), key = lambda item: -item[1])))]
+        lines.append("Slowest modules:")
+        lines.extend("  %s" % m for m in self.slowest(count))
+        return "\n".join(lines)
+
+    def asDict(self):
+        return dict(wall = self.wall,
+                    traceMemory = self.traceMemory,
+                    phaseTotals = dict(wall = self.phaseTotals('wall'),
+                                       cpu = self.phaseTotals('cpu')),
+                    modules = [m.asDict() for m in self.slowest(len(self.modules))])
+
+    def write(self, filename):
+        """Write JSON report (modules sorted by decreasing wall time)."""
+        with open(filename, 'w') as f:
+            json.dump(self.asDict(), f, indent = 1)
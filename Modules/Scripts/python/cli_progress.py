@@ -0,0 +1,128 @@
+# Copyright (c) Fraunhofer MEVIS, Germany. All rights reserved.
+# **InsertLicense** code
+"""Incremental parsing of the progress information written by CLIs.
+
+Slicer CLIs report their progress on standard output with XML
+fragments like the following::
+
+  <filter-start>
+  <filter-name>GaussianBlurImageFilter</filter-name>
+  <filter-comment> Gaussian blur </filter-comment>
+  </filter-start>
+  <filter-progress>0.25</filter-progress>
+  <filter-stage-progress>0.5</filter-stage-progress>
+
+A `ProgressParser` can be fed with chunks of output as they arrive
+(see cli_output_capture.OutputCapture.addListener), even if fragments
+are split between chunks.
+"""
+
+import re
+
+_FRAGMENT = re.compile(rb'<(filter-[a-z-]+)>([^<]*)</\1>')
+_OPENING = b'<filter-'
+
+# maximum number of bytes kept from incomplete fragments:
+MAX_PENDING = 4096
+
+def _fraction(value):
+    return min(1.0, max(0.0, float(value)))
+
+class ProgressParser(object):
+    """Keeps track of the latest `progress` (overall, 0..1, or None if
+    unknown), `stageProgress` (0..1 or None), and `stage` name (plus
+    its `comment`).  `feed` is meant to be called from another thread
+    than the one reading the attributes."""
+
+    def __init__(self):
+        self.progress = None
+        self.stageProgress = None
+        self.stage = ''
+        self.comment = ''
+        self._pending = b''
+
+    def feed(self, chunk):
+        data = self._pending + chunk
+        end = 0
+        for match in _FRAGMENT.finditer(data):
+            end = match.end()
+            tag, value = match.group(1), match.group(2).strip()
+            try:
+                if tag == b'filter-progress':
+                    self.progress = _fraction(value)
+                elif tag == b'filter-stage-progress':
+                    self.stageProgress = _fraction(value)
+                elif tag == b'filter-name':
+                    self.stage = value.decode('utf-8', 'replace')
+                    self.stageProgress = None
+                elif tag == b'filter-comment':
+                    self.comment = value.decode('utf-8', 'replace')
+            except ValueError:
+                pass # ignore malformed numbers
+        rest = data[end:]
+        start = rest.rfind(_OPENING)
+        if start >= 0:
+            rest = rest[start:] # possibly incomplete fragment
+        else:
+            rest = rest[-len(_OPENING):] # possibly incomplete opening tag
+        self._pending = rest if len(rest) <= MAX_PENDING else b''
+
+    def fraction(self):
+        """Return overall progress, falling back to the stage progress
+        for CLIs that only report the latter (None if unknown)."""
+        if self.progress is not None:
+            return self.progress
+        return self.stageProgress
+
+def estimateRemainingTime(elapsed, fraction):
+    """Return estimated remaining time (in seconds) from the elapsed
+    time and the progress fraction, or None if that is impossible."""
+    if not fraction:
+        return None
+    return elapsed * (1.0 - fraction) / fraction
+
+_EXAMPLE_OUTPUT = b'''<filter-start>
+<filter-name>GaussianBlurImageFilter</filter-name>
+<filter-comment> Gaussian blur </filter-comment>
+</filter-start>
+<filter-stage-progress>0.5</filter-stage-progress>
+<filter-progress>0.25</filter-progress>
+'''
+
+def test_complete_output():
+    parser = ProgressParser()
+    parser.feed(_EXAMPLE_OUTPUT)
+    assert parser.stage == 'GaussianBlurImageFilter'
+    assert parser.comment == 'Gaussian blur'
+    assert (parser.stageProgress, parser.progress) == (0.5, 0.25)
+
+def test_split_fragments():
+    for chunkSize in (1, 2, 3, 7, 16):
+        parser = ProgressParser()
+        for start in range(0, len(_EXAMPLE_OUTPUT), chunkSize):
+            parser.feed(_EXAMPLE_OUTPUT[start:start + chunkSize])
+        assert parser.stage == 'GaussianBlurImageFilter'
+        assert (parser.stageProgress, parser.progress) == (0.5, 0.25)
+
+def test_fraction():
+    parser = ProgressParser()
+    assert parser.fraction() is None
+    parser.feed(b'<filter-stage-progress>0.4</filter-stage-progress>')
+    assert parser.fraction() == 0.4 # stage progress as fallback
+    parser.feed(b'<filter-name>Next</filter-name><filter-progress>1.5</filter-progress>')
+    assert parser.stageProgress is None # reset with new stage
+    assert parser.fraction() == 1.0 # clamped
+    parser.feed(b'<filter-progress>bogus</filter-progress>noise without tags')
+    assert parser.fraction() == 1.0
+
+def test_pending_limit():
+    parser = ProgressParser()
+    parser.feed(b'<filter-comment>' + b'x' * MAX_PENDING) # never closed
+    assert parser._pending == b''
+    parser.feed(b'<filter-progress>0.5</filter-progress>')
+    assert parser.progress == 0.5
+
+def test_estimateRemainingTime():
+    assert estimateRemainingTime(10.0, 0.25) == 30.0
+    assert estimateRemainingTime(10.0, 0.0) is None
+    assert estimateRemainingTime(10.0, None) is None
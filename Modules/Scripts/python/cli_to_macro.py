@@ -46,11 +46,30 @@ measurement
   not supported yet (could become curve input/output), mapped to String fields with filenames
 """
 
-import os, logging, re
+import os, io, json, hashlib, filecmp, logging, re, signal, subprocess, collections
+import selectors, time
+import concurrent.futures
 logger = logging.getLogger(__name__)
 
-from ctk_cli import isCLIExecutable, listCLIExecutables, CLIModule
-from mdl_writer import MDLGroup, MDLNewline, MDLComment, MDLFile, MDLInclude
+from ctk_cli import popenCLIExecutable, CLIModule
+from mdl_writer import MDLGroup, MDLNewline, MDLComment, MDLFile, MDLInclude, MDLVerbatim, MDLCached
+from cli_cache import atomicWrite, mkstempFor, replaceFile, executableFingerprint
+from cli_discovery import findCLIExecutables, deduplicateCLIExecutables
+from cli_profiling import NO_PROFILE, REPORT_FILENAME
+
+# seconds to wait for an executable's --xml output before giving up:
+DEFAULT_XML_TIMEOUT = 60
+
+# name of the file keeping track of incrementally imported modules:
+MANIFEST_FILENAME = '.cli_import_manifest.json'
+
+# to be increased whenever the generated code changes, since
+# incremental imports need to regenerate all modules then:
+GENERATOR_VERSION = 4
+
+# suffix of the files embedding the executables' XML descriptions
+# next to the generated .script files (cf. loadEmbeddedCLIModule):
+DESCRIPTION_SUFFIX = '.cli.json'
 
 SIMPLE_TYPE_MAPPING = {
     'boolean'   : 'Bool',
@@ -63,6 +82,36 @@ SIMPLE_TYPE_MAPPING = {
     'file'      : 'String',
     }
 
+# Constant parts of the generated modules are moved into files that get
+# #included (relative to the generated .script and mhelp/*.mhelp files),
+# while others are pre-rendered only once (via MDLCached):
+_COMMON_PARAMETERS_INCLUDE = MDLInclude('$(LOCAL)/../CLIModuleParameters.script')
+_AUTO_APPLY_INCLUDE = MDLInclude('$(LOCAL)/../CLIModuleAutoApply.script')
+_AUTO_UPDATE_INCLUDE = MDLInclude('$(LOCAL)/../CLIModuleAutoUpdate.script')
+_DEBUG_WINDOW_INCLUDE = MDLInclude('$(LOCAL)/../DebugWindow.script')
+
+_USAGE_DOC_INCLUDE = MDLInclude('$(LOCAL)/../../CLIModuleUsage.mhelp')
+_COMMON_PARAMETERS_DOC_INCLUDE = MDLInclude('$(LOCAL)/../../CLIModuleParameters.mhelp')
+_AUTO_APPLY_DOC_INCLUDE = MDLInclude('$(LOCAL)/../../CLIModuleAutoApply.mhelp')
+_AUTO_UPDATE_DOC_INCLUDE = MDLInclude('$(LOCAL)/../../CLIModuleAutoUpdate.mhelp')
+
+_EXECUTABLE_PATH_DOC = MDLCached(
+    MDLGroup('Field', 'cliExecutablePath') \
+        .addTag(type_ = 'String') \
+        .addTag(text = 'Path of the CLI executable to run (set by CLIImporter)') \
+        .addTag(title = 'Executable Path') \
+        .addTag(persistent = False))
+
+_EMPTY_DOC_SECTIONS = dict((section, MDLCached(MDLGroup(section).addTag(text = "")))
+                           for section in ('Details', 'Interaction', 'Tips'))
+
+_NETWORK_PANEL = MDLGroup("NetworkPanel")
+_NETWORK_PANEL.addGroup('Button', 'update')
+_NETWORK_PANEL = MDLCached(_NETWORK_PANEL)
+
+_UPDATE_LISTENER = MDLCached(
+    MDLGroup('FieldListener', 'update').addTag(command = 'update'))
+
 def fieldName(parameter):
     """Return field name of MeVisLab macro module that shall be used
     for the given CLI module parameter.  Usually, this is identical to
@@ -90,7 +139,10 @@ def mdlDescription(cliModule, includePanelScreenshots = True):
     converted into strings using their mdl() methods.  The .def file
     references the .script file in the same directory, and the
     mhelpFile should be placed in a subdirectory named 'mhelp' (as
-    usual)."""
+    usual).  Parts common to all modules are #included from the
+    CTK_CLI directory (e.g. CLIModuleParameters.script), so the files
+    must be placed in a direct subdirectory of it (like the default
+    'generated' directory)."""
     
     moduleName = "CLI_" + cliModule.name
 
@@ -120,16 +172,14 @@ def mdlDescription(cliModule, includePanelScreenshots = True):
     else:
         docPurpose += "\n"
 
-    docUsage = """:module:`this` wraps a CLI module, which means that its execution (i.e. pressing :field:`update`) will save temporary files to disk, call the CLI executable behind the scenes, and load the results provided by it.  Compared with native MeVisLab modules, you will get limited feedback during execution, and the additional saving/loading of images introduces an additional cost (depending on the speed of your machine and I/O within the temporary directory).
-
-This documentation is extracted from the CLI module's self-description."""
-        
+    docDetails = None
     if cliModule.documentation_url:
         url = cliModule.documentation_url
         if not url.startswith('http'):
             logger.warning("%r has a bad documentation url (%r)" % (cliModule.name, url))
         else:
-            docUsage += " *Additional documentation* is provided at the following URL: %s\n" % (url, )
+            # (not starting with '*', which is special within MDL strings)
+            docDetails = "See %s for *additional documentation*.\n" % (url, )
 
     if cliModule.acknowledgements:
         docPurpose += "\nAcknowledgements\n----------------\n\n%s\n" % (
@@ -158,10 +208,13 @@ This documentation is extracted from the CLI module's self-description."""
 
     # mhelp structure (mhelp parser needs a lot of empty groups/tags)
     doc.addGroup('Purpose').addTag(text = docPurpose)
-    doc.addGroup('Usage').addTag(text = docUsage)
-    doc.addGroup('Details').addTag(text = "")
-    doc.addGroup('Interaction').addTag(text = "")
-    doc.addGroup('Tips').addTag(text = "")
+    doc.addGroup('Usage').append(_USAGE_DOC_INCLUDE)
+    if docDetails is None:
+        doc.append(_EMPTY_DOC_SECTIONS['Details'])
+    else:
+        doc.addGroup('Details').addTag(text = docDetails)
+    doc.append(_EMPTY_DOC_SECTIONS['Interaction'])
+    doc.append(_EMPTY_DOC_SECTIONS['Tips'])
 
     if includePanelScreenshots:
         windows = doc.addGroup('Windows').addTag(text = "")
@@ -181,8 +234,7 @@ This documentation is extracted from the CLI module's self-description."""
     outputsSection = MDLGroup("Outputs")
     parametersSection = MDLGroup("Parameters")
 
-    networkPanel = scriptFile.addGroup("NetworkPanel")
-    networkPanel.addGroup('Button', 'update')
+    scriptFile.append(_NETWORK_PANEL)
     
     # Commands section
     scriptFile.append(MDLNewline)
@@ -195,8 +247,7 @@ This documentation is extracted from the CLI module's self-description."""
     commands.addTag(finalizeCommand = 'cleanupTemporaryFiles')
     commands.append(MDLNewline)
 
-    commands.addGroup('FieldListener', 'update') \
-        .addTag(command = 'update')
+    commands.append(_UPDATE_LISTENER)
 
     autoApplyListener = commands.addGroup('FieldListener', 'autoApply')
     autoUpdateListener = commands.addGroup('FieldListener', 'autoUpdate')
@@ -315,89 +366,22 @@ This documentation is extracted from the CLI module's self-description."""
     else:        
         autoUpdateListener.addTag(command = 'updateIfAutoUpdate')
             
-    parametersSection.addGroup('Field', 'retainTemporaryFiles') \
-        .addTag(type_ = 'Bool')
-
     parametersSection.addGroup('Field', 'cliExecutablePath') \
         .addTag(type_ = 'String') \
         .addTag('value', os.path.abspath(cliModule.path)) \
         .addTag(persistent = False)
-
-    parametersSection.addGroup('Field', 'debugCommandline') \
-        .addTag(type_ = 'String') \
-        .addTag(editable = False)
-
-    parametersSection.addGroup('Field', 'debugStdOut') \
-        .addTag(type_ = 'String') \
-        .addTag(editable = False)
-
-    parametersSection.addGroup('Field', 'debugStdErr') \
-        .addTag(type_ = 'String') \
-        .addTag(editable = False)
-
+    parametersSection.append(_COMMON_PARAMETERS_INCLUDE)
     if autoUpdateListener:
-        parametersSection.addGroup('Field', 'autoUpdate') \
-            .addTag(type_ = 'Bool')
-
+        parametersSection.append(_AUTO_UPDATE_INCLUDE)
     if autoApplyListener:
-        parametersSection.addGroup('Field', 'autoApply') \
-            .addTag(type_ = 'Bool')
-
-    parametersSection.addGroup('Field', 'update') \
-        .addTag(type_ = 'Trigger')
-
-    parametersSection.addGroup('Field', 'runInBackground_WIP') \
-        .addTag(type_ = 'Bool')
-    parametersDoc.addGroup('Field', 'runInBackground_WIP') \
-        .addTag(type_ = 'Bool') \
-        .addTag(text = 'Execute asynchroneously; outputs will be touched after execution finished (this API is still work in progress)') \
-        .addTag(visibleInGUI = False)
-
-    parametersDoc.addGroup('Field', 'retainTemporaryFiles') \
-        .addTag(type_ = 'Bool') \
-        .addTag(text = 'Do not delete temporary files after CLI execution') \
-        .addTag(title = 'Retain Temporary Files')
-
-    parametersDoc.addGroup('Field', 'cliExecutablePath') \
-        .addTag(type_ = 'String') \
-        .addTag(text = 'Path of the CLI executable to run (set by CLIImporter)') \
-        .addTag(title = 'Executable Path') \
-        .addTag(persistent = False)
-
-    parametersDoc.addGroup('Field', 'debugCommandline') \
-        .addTag(type_ = 'String') \
-        .addTag(text = 'Full commandline used for executing the CLI module.  Actually, this string is composed for debugging; the real execution does not use this exact quoting (but calls a library function that takes arguments within an array).') \
-        .addTag(persistent = False)
-
-    parametersDoc.addGroup('Field', 'debugStdOut') \
-        .addTag(type_ = 'String') \
-        .addTag(text = 'Standard output collected during CLI execution') \
-        .addTag(persistent = False)
-
-    parametersDoc.addGroup('Field', 'debugStdErr') \
-        .addTag(type_ = 'String') \
-        .addTag(text = 'Standard error collected during CLI execution (may be very helpful if the module does not work as expected)') \
-        .addTag(persistent = False)
+        parametersSection.append(_AUTO_APPLY_INCLUDE)
 
+    parametersDoc.append(_EXECUTABLE_PATH_DOC)
+    parametersDoc.append(_COMMON_PARAMETERS_DOC_INCLUDE)
     if autoUpdateListener:
-        parametersDoc.addGroup('Field', 'autoUpdate') \
-            .addTag(type_ = 'Bool') \
-            .addTag(text = 'Automatically execute CLI module whenever any one of the input images changes (may be slow, use carefully)') \
-            .addTag(title = 'Auto update') \
-            .addTag(visibleInGUI = True)
-
+        parametersDoc.append(_AUTO_UPDATE_DOC_INCLUDE)
     if autoApplyListener:
-        parametersDoc.addGroup('Field', 'autoApply') \
-            .addTag(type_ = 'Bool') \
-            .addTag(text = 'Automatically execute CLI module whenever any one of the input parameters changes (may be slow, use carefully)') \
-            .addTag(title = 'Auto apply') \
-            .addTag(visibleInGUI = True)
-
-    parametersDoc.addGroup('Field', 'update') \
-        .addTag(type_ = 'Trigger') \
-        .addTag(text = 'Execute the CLI module') \
-        .addTag(title = 'Update') \
-        .addTag(visibleInGUI = True)
+        parametersDoc.append(_AUTO_APPLY_DOC_INCLUDE)
 
     if inputsSection:
         interface.append(inputsSection)
@@ -491,26 +475,220 @@ This documentation is extracted from the CLI module's self-description."""
 
     # debug Window section
     scriptFile.append(MDLNewline)
-    scriptFile.append(MDLInclude('$(LOCAL)/../DebugWindow.script'))
+    scriptFile.append(_DEBUG_WINDOW_INCLUDE)
 
     return defFile, scriptFile, mlabFile, mhelpFile
 
-def cliToMacroModule(executablePath, targetDirectory, defFile = True,
-                     includePanelScreenshots = True, env = None,
-                     unexpandFilename = None):
-    """Write .script/.mlab/.mhelp files for the CLI module `executablePath`
-    to `targetDirectory`[/mhelp].  If `defFile` is set to an MLDFile instance,
-    the .def file contents are appended to that object, otherwise a
-    .def file for that single module gets written."""
-    
-    logger.info("processing %s..." % executablePath)
-    #ET.dump(elementTree)
-    m = CLIModule(executablePath, env = env)
-    m.classifyParameters() # performs additional sanity checks
-
-    mdefFile, scriptFile, mlabFile, mhelpFile = mdlDescription(m, includePanelScreenshots)
+def _communicateAndReap(p, timeout):
+    """Like `p.communicate(timeout = timeout)` for a process with
+    stdout and stderr pipes, but reap it using os.wait4() in order to
+    learn its resource usage (posix only).  Returns (stdout, stderr,
+    childCPU) with the user+system CPU seconds of the process."""
+    deadline = None if timeout is None else time.monotonic() + timeout
+    def remaining():
+        if deadline is None:
+            return None
+        result = deadline - time.monotonic()
+        if result <= 0:
+            raise subprocess.TimeoutExpired(p.args, timeout)
+        return result
+
+    chunks = {p.stdout: [], p.stderr: []}
+    with selectors.DefaultSelector() as selector:
+        for pipe in chunks:
+            selector.register(pipe, selectors.EVENT_READ)
+        while selector.get_map():
+            for key, _ in selector.select(remaining()):
+                data = os.read(key.fd, 65536)
+                if data:
+                    chunks[key.fileobj].append(data)
+                else:
+                    selector.unregister(key.fileobj)
+    p.stdout.close()
+    p.stderr.close()
+
+    # the pipes are closed, but the process may not have exited yet:
+    while True:
+        pid, status, usage = os.wait4(p.pid, 0 if deadline is None else os.WNOHANG)
+        if pid:
+            break
+        time.sleep(min(0.005, remaining()))
+    p.returncode = os.waitstatus_to_exitcode(status)
+
+    return (b''.join(chunks[p.stdout]), b''.join(chunks[p.stderr]),
+            usage.ru_utime + usage.ru_stime)
+
+def extractXMLDescription(executablePath, env = None, timeout = DEFAULT_XML_TIMEOUT,
+                          profile = NO_PROFILE):
+    """Run the CLI executable `executablePath` with --xml and return
+    its standard output (i.e. the raw XML self-description).  In
+    contrast to ctk_cli.getXMLDescription, the executable is killed
+    if it does not finish within `timeout` seconds (None means no
+    timeout), and no temporary files are involved.
+
+    On posix systems, the CPU time of the executable is added to the
+    'extract' phase of `profile`."""
+    kwargs = {}
+    if os.name == 'posix':
+        # own process group, so that we can kill launched children, too:
+        kwargs['start_new_session'] = True
+    childCPU = None
+    with profile.phase('extract'):
+        p = popenCLIExecutable([executablePath, '--xml'], env = env,
+                               stdout = subprocess.PIPE, stderr = subprocess.PIPE,
+                               **kwargs)
+        try:
+            if os.name == 'posix':
+                stdout, stderr, childCPU = _communicateAndReap(p, timeout)
+            else:
+                stdout, stderr = p.communicate(timeout = timeout)
+        except subprocess.TimeoutExpired:
+            if os.name == 'posix':
+                try:
+                    os.killpg(p.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass # (exited meanwhile)
+            else:
+                p.kill()
+            p.wait()
+            p.stdout.close()
+            p.stderr.close()
+            raise RuntimeError("Calling %s timed out (no --xml output within %s seconds)" % (
+                executablePath, timeout))
+    if childCPU is not None:
+        profile.addChildCPU('extract', childCPU)
+    for line in stderr.decode('utf-8', 'replace').splitlines():
+        logger.warning('%s: %s' % (os.path.basename(executablePath), line))
+    if p.returncode:
+        raise RuntimeError("Calling %s failed (exit code %d)" % (executablePath, p.returncode))
+    return stdout
+
+def _loadXMLDescription(executablePath, env, timeout, cache, profile):
+    xml = None
+    if cache is not None:
+        with profile.phase('cache'):
+            xml = cache.get(executablePath)
+    if xml is None:
+        xml = extractXMLDescription(executablePath, env, timeout, profile)
+        if cache is not None:
+            cache.put(executablePath, xml)
+    return xml
+
+def parseCLIDescription(xml, executablePath, profile = NO_PROFILE):
+    """Return CLIModule instance for the given raw XML description
+    (bytes) of the CLI executable `executablePath`."""
+    with profile.phase('parse'):
+        m = CLIModule(stream = io.BytesIO(xml))
+        m.path = executablePath
+        m.classifyParameters() # performs additional sanity checks
+    return m
+
+def loadCLIModule(executablePath, env = None, timeout = DEFAULT_XML_TIMEOUT,
+                  cache = None, profile = NO_PROFILE):
+    """Return CLIModule instance for the CLI executable
+    `executablePath` (see `extractXMLDescription` for the meaning of
+    `env` and `timeout`).  If `cache` is given (a
+    cli_cache.CLIDescriptionCache instance), the executable is only
+    run if there is no valid cache entry for it yet.  The 'cache',
+    'extract' and 'parse' phases are recorded in `profile` (a
+    cli_profiling.ModuleProfile)."""
+    xml = _loadXMLDescription(executablePath, env, timeout, cache, profile)
+    return parseCLIDescription(xml, executablePath, profile)
+
+def _loadCLIModuleAndXML(executablePath, env, timeout, cache, profile):
+    xml = _loadXMLDescription(executablePath, env, timeout, cache, profile)
+    return parseCLIDescription(xml, executablePath, profile), xml
+
+def loadEmbeddedCLIModule(executablePath, descriptionFilename, env = None,
+                          timeout = DEFAULT_XML_TIMEOUT):
+    """Return CLIModule instance for the CLI executable
+    `executablePath`, parsed from the description embedded into a
+    generated module (see `writeMacroModule`).  The executable is only
+    run (cf. `loadCLIModule`) if that description is missing or was
+    generated for a different version of the executable, i.e. if its
+    fingerprint (see `cli_cache.executableFingerprint`) no longer
+    matches."""
+    try:
+        with open(descriptionFilename) as f:
+            description = json.load(f)
+        upToDate = (description['fingerprint'] == executableFingerprint(executablePath))
+    except (OSError, ValueError, KeyError):
+        upToDate = False
+    if upToDate:
+        return parseCLIDescription(
+            description['xml'].encode('utf-8', 'surrogateescape'), executablePath)
+    logger.warning("%s is missing or outdated, running %s --xml (re-importing the module is recommended)"
+                   % (descriptionFilename, executablePath))
+    return loadCLIModule(executablePath, env, timeout)
+
+class _HashingWriter(object):
+    """Encodes text chunks as UTF-8, writing them to a binary file
+    while computing the SHA-1 of the written data."""
+    def __init__(self, f):
+        self._file = f
+        self.sha1 = hashlib.sha1()
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        self.sha1.update(data)
+        self._file.write(data)
+
+def writeMDLFile(mdlFile, filename):
+    """Write the given MDLFile to `filename` (UTF-8 encoded), unless
+    the file already has exactly that content (in order to not touch
+    its mtime).  The MDL code is streamed into a temporary file, which
+    atomically replaces `filename` if the content changed (see
+    `cli_cache.replaceFile`).  Returns the SHA-1 hex digest of the
+    content."""
+    fd, tempFilename = mkstempFor(filename)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            writer = _HashingWriter(f)
+            mdlFile.render(writer.write)
+        if os.path.exists(filename) and filecmp.cmp(tempFilename, filename, shallow = False):
+            os.unlink(tempFilename)
+        else:
+            replaceFile(tempFilename, filename)
+    except:
+        if os.path.exists(tempFilename):
+            os.unlink(tempFilename)
+        raise
+    return writer.sha1.hexdigest()
+
+def _writeFileIfChanged(data, filename):
+    # like writeMDLFile, for data (bytes) that is already in memory
+    try:
+        with open(filename, 'rb') as f:
+            unchanged = (f.read() == data)
+    except (IOError, OSError):
+        unchanged = False
+    if not unchanged:
+        atomicWrite(filename, data)
+    return hashlib.sha1(data).hexdigest()
+
+def writeMacroModule(cliModule, targetDirectory, defFile = True,
+                     includePanelScreenshots = True, unexpandFilename = None,
+                     outputs = None, profile = NO_PROFILE, xml = None):
+    """Write .script/.mlab/.mhelp files for the given CLIModule
+    instance to `targetDirectory`[/mhelp].  See `cliToMacroModule`
+    for the meaning of the remaining arguments.  If `outputs` is
+    given, it should be a dict which gets filled with the written
+    files' paths (relative to `targetDirectory`) mapped to their
+    contents' SHA-1 hashes.
+
+    If the raw `xml` description of the module is given, it is
+    embedded (together with the executable's fingerprint) into a
+    <name>.cli.json file next to the .script file, so that the
+    generated module does not need to run the executable when it is
+    instantiated (see `loadEmbeddedCLIModule`)."""
+
+    m = cliModule
+    with profile.phase('describe'):
+        mdefFile, scriptFile, mlabFile, mhelpFile = mdlDescription(m, includePanelScreenshots)
+
+    files = []
     if defFile is True:
-        mdefFile.write(os.path.join(targetDirectory, "%s.def" % m.name))
+        files.append((mdefFile, "%s.def" % m.name))
     else:
         if defFile: # not empty, add separating newline
             defFile.append(MDLNewline)
@@ -520,48 +698,294 @@ def cliToMacroModule(executablePath, targetDirectory, defFile = True,
         cliExecutablePath = scriptFile.group('Interface').group('Parameters').group('Field', 'cliExecutablePath').tag('value')
         cliExecutablePath.tagValue = unexpandFilename(cliExecutablePath.tagValue)
 
-    scriptFile.write(os.path.join(targetDirectory, "%s.script" % m.name))
-    mlabFile.write(os.path.join(targetDirectory, "%s.mlab" % m.name))
-    mhelpFile.write(os.path.join(targetDirectory, "mhelp", "CLI_%s.mhelp" % m.name))
+    files.append((scriptFile, "%s.script" % m.name))
+    files.append((mlabFile, "%s.mlab" % m.name))
+    files.append((mhelpFile, "mhelp/CLI_%s.mhelp" % m.name))
+
+    with profile.phase('write'):
+        for mdlFile, relativePath in files:
+            digest = writeMDLFile(
+                mdlFile, os.path.join(targetDirectory, *relativePath.split('/')))
+            if outputs is not None:
+                outputs[relativePath] = digest
+
+        if xml is not None:
+            relativePath = m.name + DESCRIPTION_SUFFIX
+            description = dict(fingerprint = executableFingerprint(m.path),
+                               xml = xml.decode('utf-8', 'surrogateescape'))
+            digest = _writeFileIfChanged(
+                json.dumps(description, sort_keys = True).encode('ascii'),
+                os.path.join(targetDirectory, relativePath))
+            if outputs is not None:
+                outputs[relativePath] = digest
 
     return mdefFile
 
+def cliToMacroModule(executablePath, targetDirectory, defFile = True,
+                     includePanelScreenshots = True, env = None,
+                     unexpandFilename = None, timeout = DEFAULT_XML_TIMEOUT,
+                     cache = None, profile = NO_PROFILE):
+    """Write .script/.mlab/.mhelp files for the CLI module `executablePath`
+    to `targetDirectory`[/mhelp].  If `defFile` is set to an MLDFile instance,
+    the .def file contents are appended to that object, otherwise a
+    .def file for that single module gets written.  See
+    `loadCLIModule` for the meaning of `cache` and `profile`."""
+    
+    logger.info("processing %s..." % executablePath)
+    m, xml = _loadCLIModuleAndXML(executablePath, env, timeout, cache, profile)
+    return writeMacroModule(m, targetDirectory, defFile,
+                            includePanelScreenshots, unexpandFilename,
+                            profile = profile, xml = xml)
+
+def _loadCLIModulesInParallel(executablePaths, jobs, env, timeout, cache,
+                              profiles = None):
+    """Generator yielding one concurrent.futures.Future per entry of
+    `executablePaths` (in the same order), each resulting in a
+    (CLIModule, xml) tuple loaded by a pool of `jobs` worker threads.  At most
+    2*`jobs` executables are queried ahead of the consumer.
+    `profiles` may map paths to cli_profiling.ModuleProfile instances.
+
+    If the consumer stops early (i.e. the generator is closed or an
+    exception is raised), the queued executables are not queried
+    anymore, and running queries are not waited for."""
+    executor = concurrent.futures.ThreadPoolExecutor(jobs)
+    pending = collections.deque()
+    try:
+        for path in executablePaths:
+            profile = profiles[path] if profiles else NO_PROFILE
+            pending.append(executor.submit(_loadCLIModuleAndXML, path, env, timeout,
+                                           cache, profile))
+            if len(pending) >= 2 * jobs:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait = False)
+
+def _loadManifest(targetDirectory):
+    try:
+        with open(os.path.join(targetDirectory, MANIFEST_FILENAME)) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+def _staleOutputs(previousModules, currentModules):
+    """Return sorted list of the (relative) output filenames listed in
+    the `previousModules` manifest entries that are not listed in
+    `currentModules` anymore."""
+    currentOutputs = set()
+    for entry in currentModules.values():
+        currentOutputs.update(entry['outputs'])
+    result = set()
+    for entry in previousModules.values():
+        result.update(entry['outputs'])
+    return sorted(result - currentOutputs)
+
+_TEST_XML = b'''<?xml version="1.0" encoding="utf-8"?>
+<executable><title>Test</title><description>d</description>
+  <documentation-url>http://www.slicer.org/slicerWiki/index.php/Test</documentation-url>
+  <parameters><label>IO</label><description>io</description>
+    <image><name>inputVolume</name><label>In</label><channel>input</channel><index>0</index>
+      <description>in</description></image>
+  </parameters></executable>'''
+
+def test_usage_documentation():
+    for xml in (_TEST_XML, re.sub(b'<documentation-url>.*</documentation-url>', b'', _TEST_XML)):
+        cliModule = CLIModule(stream = io.BytesIO(xml))
+        cliModule.path = '/opt/cli-modules/Test'
+        mhelp = mdlDescription(cliModule, includePanelScreenshots = False)[3].mdl()
+        # the shared usage text is always included, never duplicated:
+        assert mhelp.count('#include $(LOCAL)/../../CLIModuleUsage.mhelp') == 1
+        assert 'wraps a CLI module' not in mhelp
+        assert ('http://www.slicer.org/' in mhelp) == (xml == _TEST_XML)
+
+def test_staleOutputs():
+    previous = {
+        '/bin/A': dict(fingerprint = 'a', outputs = ['A.script', 'mhelp/A.mhelp', 'shared.png']),
+        '/bin/B': dict(fingerprint = 'b', outputs = ['B.script', 'shared.png']),
+        '/bin/C': dict(fingerprint = 'c', outputs = ['C.script']),
+        }
+    current = {
+        '/bin/A': dict(fingerprint = 'a2', outputs = ['A.script']),
+        '/bin/C': previous['/bin/C'], # carried forward
+        }
+    assert _staleOutputs(previous, current) == ['B.script', 'mhelp/A.mhelp', 'shared.png']
+    assert _staleOutputs(previous, previous) == []
+    assert _staleOutputs({}, current) == []
+
+class ImportProgress(tuple):
+    """(index, successful, total, path) tuple yielded by
+    `importAllCLIs`.  Additionally, the following attributes describe
+    the outcome of processing the previous module (they are all None
+    for the first tuple):
+
+    previousPath
+      path of the previously processed executable
+    error
+      error message if that module could not be imported (else None)
+    profile
+      its cli_profiling.ModuleProfile (None if profiling is disabled)
+    """
+
+    def __new__(cls, index, successful, total, path,
+                previousPath = None, error = None, profile = None):
+        result = tuple.__new__(cls, (index, successful, total, path))
+        result.previousPath = previousPath
+        result.error = error
+        result.profile = profile
+        return result
+
 def importAllCLIs(importPaths, targetDirectory, defFileName = 'CLIModules.def',
                   includePanelScreenshots = True, env = None,
-                  unexpandFilename = None):
+                  unexpandFilename = None, jobs = None,
+                  timeout = DEFAULT_XML_TIMEOUT, cache = None,
+                  incremental = False, recursive = False, maxDepth = None,
+                  duplicatePolicy = 'newest', profile = None):
     """Generator function that imports any number of CLI modules at
     once.  `importPaths` shall contain either directory names to be
-    scanned (non-recursively) or paths of CLI executables.  Before
-    importing, the target directory will be wiped.  All module
-    definitions will be put into the same .def file, and all generated
-    files will be written to `targetDirectory` and an 'mhelp'
-    subdirectory, which must both exist already.  See
-    `cliToMacroModule` for more information.  The generator will yield
-    (index, total, path) tuples for progress display (index being
-    1-based for this purpose)."""
+    scanned (non-recursively, unless `recursive` is set, see
+    `cli_discovery.findCLIExecutables`) or paths of CLI executables.
+    All module definitions will be put into the same .def file, and
+    all generated files will be written to `targetDirectory` and an
+    'mhelp' subdirectory, which must both exist already.  See
+    `cliToMacroModule` for more information.  If the same CLI module
+    is found multiple times (e.g. in several Slicer installations),
+    only one executable is imported, chosen by `duplicatePolicy` (see
+    `cli_discovery.deduplicateCLIExecutables`, None disables this
+    filtering).  The generator will yield
+    (index, successful, total, path) tuples for progress display
+    (index being 0-based, path being empty for the final tuple, see
+    also `ImportProgress`).
+
+    If `jobs` is greater than one, the XML descriptions are extracted
+    and parsed by that many worker threads in parallel; the generated
+    files (and the order of progress tuples) are the same as in the
+    serial case.  Each executable gets killed if it does not provide
+    its description within `timeout` seconds.  Pass a
+    cli_cache.CLIDescriptionCache instance as `cache` in order to skip
+    running executables that did not change since the last import.
+
+    Generated files are only written if their contents changed (and
+    then atomically).  Existing files are never removed, unless
+    `incremental` is set: Then, a manifest of all imported
+    executables' fingerprints and the generated files is kept in
+    `targetDirectory`, modules are only regenerated for executables
+    that were added or changed since the last import, and files
+    generated for executables that are no longer imported are
+    deleted.  If an executable still exists but fails to be imported
+    (e.g. because of a timeout), the module generated for it
+    previously is kept.
+
+    If a cli_profiling.ImportProfile instance is passed as `profile`,
+    it gets filled with the timings of all processed modules, which
+    are also attached to the progress tuples, and a JSON report is
+    written to `targetDirectory` (see cli_profiling.REPORT_FILENAME)."""
+
+    if profile is not None:
+        profile.start()
 
     defFile = MDLFile()
 
-    executablePaths = []
-
-    for path in importPaths:
-        if os.path.isdir(path):
-            executablePaths.extend(listCLIExecutables(path))
-        elif isCLIExecutable(path):
-            executablePaths.append(path)
+    executablePaths = findCLIExecutables(importPaths, recursive, maxDepth, jobs)
+    if duplicatePolicy is not None:
+        executablePaths = deduplicateCLIExecutables(executablePaths, duplicatePolicy)
+
+    options = dict(generatorVersion = GENERATOR_VERSION,
+                   includePanelScreenshots = includePanelScreenshots,
+                   unexpandFilename = unexpandFilename is not None)
+    manifest = dict(options = options, modules = {})
+    previousModules = {}
+    reusable = False
+    if incremental:
+        previous = _loadManifest(targetDirectory)
+        if previous:
+            previousModules = previous['modules']
+            reusable = (previous.get('options') == options)
+
+    # find out which executables need to be (re-)imported:
+    fingerprints = {}
+    unchanged = set()
+    for path in executablePaths:
+        try:
+            fingerprints[path] = executableFingerprint(path)
+        except OSError:
+            continue
+        previous = previousModules.get(path)
+        if reusable and previous and previous['fingerprint'] == fingerprints[path] and all(
+                os.path.exists(os.path.join(targetDirectory, *relativePath.split('/')))
+                for relativePath in previous['outputs']):
+            unchanged.add(path)
+    changedPaths = [path for path in executablePaths if path not in unchanged]
+
+    moduleProfiles = {}
+    if profile is not None:
+        for path in changedPaths:
+            moduleProfiles[path] = profile.moduleProfile(path)
+
+    if jobs is not None and jobs > 1:
+        futures = _loadCLIModulesInParallel(
+            changedPaths, jobs, env, timeout, cache, moduleProfiles)
+    else:
+        futures = None
 
     successful = 0
     total = len(executablePaths)
+    outcome = dict(previousPath = None, error = None, profile = None)
     for i, path in enumerate(executablePaths):
-        yield (i, successful, total, path)
+        yield ImportProgress(i, successful, total, path, **outcome)
+        moduleProfile = moduleProfiles.get(path, NO_PROFILE)
+        outcome = dict(previousPath = path, error = None,
+                       profile = moduleProfiles.get(path))
         try:
-            cliToMacroModule(path, targetDirectory, defFile,
-                             includePanelScreenshots, env = env,
-                             unexpandFilename = unexpandFilename)
+            if path in unchanged:
+                entry = previousModules[path]
+                if defFile: # not empty, add separating newline
+                    defFile.append(MDLNewline)
+                defFile.append(MDLVerbatim(entry['definition']))
+            else:
+                logger.info("processing %s..." % path)
+                if futures is None:
+                    m, xml = _loadCLIModuleAndXML(path, env, timeout, cache, moduleProfile)
+                else:
+                    m, xml = next(futures).result()
+                outputs = {}
+                mdefFile = writeMacroModule(m, targetDirectory, defFile,
+                                            includePanelScreenshots, unexpandFilename,
+                                            outputs = outputs, profile = moduleProfile,
+                                            xml = xml)
+                entry = dict(fingerprint = fingerprints.get(path),
+                             definition = mdefFile.mdl()[:-1],
+                             outputs = outputs)
+            manifest['modules'][path] = entry
             successful += 1
         except Exception as e:
             logger.error(str(e))
-    yield (total, successful, total, "")
-
-    with open(os.path.join(targetDirectory, defFileName), "w") as f:
-        f.write(defFile.mdl())
+            outcome['error'] = str(e) or e.__class__.__name__
+            previous = previousModules.get(path)
+            if previous is not None:
+                # keep the previous module, but retry the next time
+                # (by storing a fingerprint that never matches):
+                if defFile:
+                    defFile.append(MDLNewline)
+                defFile.append(MDLVerbatim(previous['definition']))
+                manifest['modules'][path] = dict(previous, fingerprint = None)
+    yield ImportProgress(total, successful, total, "", **outcome)
+
+    writeMDLFile(defFile, os.path.join(targetDirectory, defFileName))
+
+    if incremental:
+        # remove files generated for executables that are gone:
+        for relativePath in _staleOutputs(previousModules, manifest['modules']):
+            logger.info("removing %s..." % relativePath)
+            try:
+                os.unlink(os.path.join(targetDirectory, *relativePath.split('/')))
+            except OSError:
+                pass
+        atomicWrite(os.path.join(targetDirectory, MANIFEST_FILENAME),
+                    json.dumps(manifest, indent = 1, sort_keys = True).encode('utf-8'))
+
+    if profile is not None:
+        profile.stop()
+        profile.write(os.path.join(targetDirectory, REPORT_FILENAME))
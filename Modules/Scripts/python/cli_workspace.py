@@ -0,0 +1,316 @@
+# Copyright (c) Fraunhofer MEVIS, Germany. All rights reserved.
+# **InsertLicense** code
+"""Managed directories for the temporary files exchanged with CLI modules.
+
+All workspaces of a process live within one session directory
+(mevislab-cli-<pid>-<random suffix>), which is created within the
+first usable candidate base directory: RAM-backed locations like
+/dev/shm are preferred (unless they have less than `minFreeBytes`
+free), with the default temporary directory as fallback.  The
+candidates can be configured via the MEVISLAB_CLI_WORKSPACE
+environment variable (os.pathsep-separated list of directories).
+Since these are usually world-writable, the session directory is
+created by tempfile.mkdtemp(), i.e. with an unpredictable name and
+accessible only by the current user.
+
+Each `Workspace` keeps track of its files and when they were last
+used.  Files created as evictable (i.e. those that can be re-created
+on demand, like saved input images) are removed, least recently used
+first, when a workspace exceeds the per-instance quota or all
+workspaces together exceed the global quota.  Session directories of
+processes that no longer exist (e.g. after a crash) are removed when
+the `WorkspaceManager` is created.
+"""
+
+import os, re, time, shutil, logging, tempfile, threading
+logger = logging.getLogger(__name__)
+
+SESSION_PREFIX = 'mevislab-cli-'
+
+ENVIRONMENT_VARIABLE = 'MEVISLAB_CLI_WORKSPACE'
+
+DEFAULT_RAM_DIRECTORIES = ('/dev/shm', )
+
+DEFAULT_MIN_FREE_BYTES = 1024 * 1024 * 1024
+DEFAULT_INSTANCE_QUOTA = 2 * 1024 * 1024 * 1024
+DEFAULT_GLOBAL_QUOTA = 8 * 1024 * 1024 * 1024
+
+# (non-posix platforms cannot check for dead processes without side
+# effects, so orphaned session directories are recognized by their age)
+ORPHAN_AGE = 7 * 24 * 3600
+
+def candidateDirectories():
+    """Return list of base directories for the session directory,
+    preferred ones first."""
+    configured = os.environ.get(ENVIRONMENT_VARIABLE)
+    if configured:
+        result = [path for path in configured.split(os.pathsep) if path]
+    else:
+        result = list(DEFAULT_RAM_DIRECTORIES)
+    result.append(tempfile.gettempdir())
+    return result
+
+def _processExists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass # e.g. EPERM, i.e. exists but belongs to someone else
+    return True
+
+def sweepOrphanedSessions(baseDirectory):
+    """Remove session directories within `baseDirectory` that belong
+    to processes that are no longer running."""
+    pattern = re.compile(re.escape(SESSION_PREFIX) + '([0-9]+)-')
+    try:
+        entries = list(os.scandir(baseDirectory))
+    except OSError:
+        return
+    for entry in entries:
+        match = pattern.match(entry.name)
+        if not match or not entry.is_dir(follow_symlinks = False):
+            continue
+        if hasattr(os, 'getuid'):
+            try:
+                if entry.stat(follow_symlinks = False).st_uid != os.getuid():
+                    continue # not ours
+            except OSError:
+                continue
+        pid = int(match.group(1))
+        if pid == os.getpid():
+            continue
+        if os.name == 'posix':
+            orphaned = not _processExists(pid)
+        else:
+            try:
+                orphaned = (time.time() - entry.stat().st_mtime > ORPHAN_AGE)
+            except OSError:
+                continue
+        if orphaned:
+            logger.info("removing orphaned workspace %s" % entry.path)
+            shutil.rmtree(entry.path, ignore_errors = True)
+
+
+class Workspace(object):
+    """Directory for the temporary files of one CLI module instance
+    (see `WorkspaceManager.createWorkspace`)."""
+
+    def __init__(self, manager, path):
+        self.manager = manager
+        self.path = path
+        self.busy = False # set while a CLI process may access our files
+        self._files = {} # filename -> [lastUse, evictable]
+
+    def mkstemp(self, suffix, evictable = False):
+        """Return (fd, filename) tuple for a new file within this
+        workspace.  `evictable` files may be removed at any time
+        (by `enforceQuotas`, unless `busy` is set), and need to be
+        re-created if missing."""
+        fd, filename = tempfile.mkstemp(suffix = suffix, dir = self.path)
+        self._files[filename] = [time.monotonic(), evictable]
+        return fd, filename
+
+    def scratchFile(self, name):
+        """Return (fd, filename) tuple for the scratch file `name`,
+        which is re-used (truncated) on every call, in order to not
+        pile up files like logs of every run."""
+        filename = os.path.join(self.path, name)
+        fd = os.open(filename, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        self._files[filename] = [time.monotonic(), False]
+        return fd, filename
+
+    def addFile(self, filename, evictable = False):
+        """Register a file created within this workspace by other means
+        than `mkstemp` (e.g. companion files)."""
+        if filename not in self._files:
+            self._files[filename] = [time.monotonic(), evictable]
+
+    def touch(self, filename):
+        """Mark file as recently used (cf. LRU eviction)."""
+        entry = self._files.get(filename)
+        if entry is not None:
+            entry[0] = time.monotonic()
+
+    def remove(self, filename):
+        self._files.pop(filename, None)
+        if os.path.exists(filename):
+            os.unlink(filename)
+
+    def _evictableFiles(self):
+        result = []
+        if self.busy:
+            return result
+        for filename, (lastUse, evictable) in self._files.items():
+            if evictable:
+                try:
+                    result.append((lastUse, os.path.getsize(filename), filename, self))
+                except OSError:
+                    pass
+        return result
+
+    def size(self):
+        """Return total size of the files within this workspace."""
+        result = 0
+        for filename in self._files:
+            try:
+                result += os.path.getsize(filename)
+            except OSError:
+                pass
+        return result
+
+    def enforceQuotas(self):
+        """Evict files if this workspace (or all workspaces together)
+        exceed their quota (see WorkspaceManager)."""
+        self.manager.enforceQuotas(self)
+
+    def cleanup(self):
+        """Remove the whole workspace."""
+        self.manager._unregister(self)
+        self._files = {}
+        shutil.rmtree(self.path, ignore_errors = True)
+
+
+class WorkspaceManager(object):
+    """Creates `Workspace` instances within a session directory (see
+    module docstring) and enforces their quotas (in bytes, None
+    meaning unlimited)."""
+
+    def __init__(self, candidates = None, minFreeBytes = DEFAULT_MIN_FREE_BYTES,
+                 instanceQuota = DEFAULT_INSTANCE_QUOTA,
+                 globalQuota = DEFAULT_GLOBAL_QUOTA):
+        self.candidates = candidates if candidates is not None else candidateDirectories()
+        self.minFreeBytes = minFreeBytes
+        self.instanceQuota = instanceQuota
+        self.globalQuota = globalQuota
+        self._workspaces = []
+        self._lock = threading.Lock()
+        self._sessionDirectories = {}
+        for baseDirectory in self.candidates:
+            sweepOrphanedSessions(baseDirectory)
+
+    def _usable(self, baseDirectory):
+        if not (os.path.isdir(baseDirectory) and os.access(baseDirectory, os.W_OK | os.X_OK)):
+            return False
+        try:
+            return shutil.disk_usage(baseDirectory).free >= self.minFreeBytes
+        except OSError:
+            return False
+
+    def baseDirectory(self):
+        """Return first usable candidate directory (checked anew on
+        each call, since free space may change)."""
+        for baseDirectory in self.candidates[:-1]:
+            if self._usable(baseDirectory):
+                return baseDirectory
+        return self.candidates[-1]
+
+    def _sessionDirectory(self, baseDirectory):
+        result = self._sessionDirectories.get(baseDirectory)
+        if result is None:
+            result = tempfile.mkdtemp(prefix = '%s%d-' % (SESSION_PREFIX, os.getpid()),
+                                      dir = baseDirectory)
+            self._sessionDirectories[baseDirectory] = result
+        return result
+
+    def createWorkspace(self, prefix = None):
+        with self._lock:
+            path = tempfile.mkdtemp(prefix = prefix,
+                                    dir = self._sessionDirectory(self.baseDirectory()))
+            result = Workspace(self, path)
+            self._workspaces.append(result)
+        return result
+
+    def _unregister(self, workspace):
+        with self._lock:
+            if workspace in self._workspaces:
+                self._workspaces.remove(workspace)
+
+    def _evict(self, candidates, excessBytes):
+        for lastUse, size, filename, workspace in sorted(candidates):
+            if excessBytes <= 0:
+                break
+            logger.debug("evicting %s" % filename)
+            try:
+                # (the entry is kept, so that the file counts again
+                # when it is re-created)
+                os.unlink(filename)
+            except OSError:
+                continue
+            excessBytes -= size
+
+    def enforceQuotas(self, workspace = None):
+        """Evict least recently used evictable files of `workspace` if
+        it exceeds the instance quota, and of all workspaces if their
+        total size exceeds the global quota."""
+        if workspace is not None and self.instanceQuota is not None:
+            excess = workspace.size() - self.instanceQuota
+            if excess > 0:
+                self._evict(workspace._evictableFiles(), excess)
+        if self.globalQuota is not None:
+            with self._lock:
+                workspaces = list(self._workspaces)
+            excess = sum(w.size() for w in workspaces) - self.globalQuota
+            if excess > 0:
+                self._evict([f for w in workspaces for f in w._evictableFiles()], excess)
+
+_defaultManager = None
+
+def defaultManager():
+    """Return the WorkspaceManager shared by all modules of this
+    process (created on first use, sweeping orphaned sessions)."""
+    global _defaultManager
+    if _defaultManager is None:
+        _defaultManager = WorkspaceManager()
+    return _defaultManager
+
+
+def test_sweepOrphanedSessions():
+    baseDirectory = tempfile.mkdtemp()
+    try:
+        manager = WorkspaceManager([baseDirectory], minFreeBytes = 0)
+        session = os.path.dirname(manager.createWorkspace().path)
+        assert os.path.basename(session).startswith('%s%d-' % (SESSION_PREFIX, os.getpid()))
+        if os.name == 'posix':
+            assert os.stat(session).st_mode & 0o777 == 0o700
+            orphaned = os.path.join(baseDirectory, SESSION_PREFIX + '999999999-abc')
+            os.mkdir(orphaned)
+            unrelated = os.path.join(baseDirectory, 'mevislab-cli-other')
+            os.mkdir(unrelated)
+            sweepOrphanedSessions(baseDirectory)
+            assert sorted(os.listdir(baseDirectory)) == sorted(
+                [os.path.basename(session), 'mevislab-cli-other'])
+    finally:
+        shutil.rmtree(baseDirectory)
+
+def test_quota_eviction_order():
+    baseDirectory = tempfile.mkdtemp()
+    try:
+        manager = WorkspaceManager([baseDirectory], minFreeBytes = 0,
+                                   instanceQuota = 250, globalQuota = 350)
+        def createFiles(workspace, evictable):
+            result = []
+            for _ in range(3):
+                fd, filename = workspace.mkstemp('.nrrd', evictable)
+                os.write(fd, b'x' * 100)
+                os.close(fd)
+                result.append(filename)
+            return result
+        first = manager.createWorkspace()
+        a, b, c = createFiles(first, True)
+        first.touch(a) # b is least recently used now
+        first.enforceQuotas()
+        assert [os.path.exists(f) for f in (a, b, c)] == [True, False, True]
+
+        second = manager.createWorkspace()
+        kept = createFiles(second, False)
+        second.busy = True
+        second.enforceQuotas() # 500 bytes total, evict from `first` only
+        assert [os.path.exists(f) for f in (a, c)] == [False, False]
+        assert all(os.path.exists(f) for f in kept)
+
+        second.busy = False
+        first.cleanup()
+        assert manager.baseDirectory() == baseDirectory
+    finally:
+        shutil.rmtree(baseDirectory)
@@ -6,6 +6,31 @@ syntactically valid (and nicely formatted) MDL files.
 
 import re
 
+_needsQuoting = re.compile('[ \t{}=]|//').search
+_escapeQuoted = re.compile(r'(["\\])').sub
+
+# memoized results of _mdlString() (the same names and values occur
+# over and over again in generated files):
+_mdlStrings = {}
+_MAX_MDL_STRINGS = 16384
+
+def _mdlString(value):
+    try:
+        return _mdlStrings[value]
+    except KeyError:
+        pass
+    if value == '':
+        result = '""'
+    elif "\n" in value:
+        result = '"*%s*"' % value.replace('\\', '\\\\').replace('"*', '"\\*')
+    elif _needsQuoting(value):
+        result = '"%s"' % _escapeQuoted(r'\\\1', value)
+    else:
+        result = value
+    if len(_mdlStrings) < _MAX_MDL_STRINGS:
+        _mdlStrings[value] = result
+    return result
+
 def mdlValue(value):
     """Convert python value into MDL string representation.  Lists are
     converted into space-separated vector strings, assuming numeric
@@ -14,17 +39,12 @@ def mdlValue(value):
         return "yes" if value else "no"
     elif isinstance(value, list):
         value = " ".join(map(mdlValue, value))
-    value = str(value)
-    if value == '':
-        return '""'
-    if "\n" in value:
-        return '"*%s*"' % value.replace('\\', '\\\\').replace('"*', '"\\*')
-    if re.search('[ \t{}=]', value) or '//' in value:
-        return '"%s"' % re.sub(r'(["\\])', r'\\\1', value)
-    return value
+    return _mdlString(str(value))
 
 
 class MDLTag(object):
+    __slots__ = ('tagName', 'tagValue')
+
     def __init__(self, name = None, value = '', **kwargs):
         if name is None:
             (name, value), = kwargs.items()
@@ -47,7 +67,92 @@ class MDLTag(object):
                               mdlValue(self.tagValue))
 
 
+# maps indentation -> indentation of child elements (avoids repeatedly
+# building the same prefix strings while rendering):
+_childIndentation = {}
+
+def _indentChildren(indentation):
+    try:
+        return _childIndentation[indentation]
+    except KeyError:
+        result = _childIndentation[indentation] = indentation + "  "
+        return result
+
+
+def _indexKey(child):
+    if isinstance(child, MDLTag):
+        return (MDLTag, child.tagName)
+    if isinstance(child, MDLGroup):
+        return (MDLGroup, child.tagName)
+
+
 class _MDLParent(list):
+    """Base class for MDL elements containing other elements.  For
+    fast tag() / group() lookups, an index of the children by name is
+    built lazily and kept up-to-date when children are appended
+    (other modifications just invalidate it).  Hence, the names of
+    children must not be changed after adding them (values may)."""
+
+    __slots__ = ('_index', )
+
+    def __init__(self, *args):
+        list.__init__(self, *args)
+        self._index = None
+
+    def _buildIndex(self):
+        self._index = {}
+        for child in self:
+            self._indexChild(child)
+        return self._index
+
+    def _indexChild(self, child):
+        key = _indexKey(child)
+        if key is not None:
+            self._index.setdefault(key, []).append(child)
+
+    def append(self, child):
+        list.append(self, child)
+        if self._index is not None:
+            self._indexChild(child)
+
+    def extend(self, children):
+        if self._index is None:
+            list.extend(self, children)
+        else:
+            for child in children:
+                self.append(child)
+
+    def _invalidatingIndex(method):
+        def wrapper(self, *args, **kwargs):
+            self._index = None
+            return method(self, *args, **kwargs)
+        wrapper.__name__ = method.__name__
+        wrapper.__doc__ = method.__doc__
+        return wrapper
+
+    insert = _invalidatingIndex(list.insert)
+    remove = _invalidatingIndex(list.remove)
+    pop = _invalidatingIndex(list.pop)
+    clear = _invalidatingIndex(list.clear)
+    sort = _invalidatingIndex(list.sort)
+    reverse = _invalidatingIndex(list.reverse)
+    __setitem__ = _invalidatingIndex(list.__setitem__)
+    __delitem__ = _invalidatingIndex(list.__delitem__)
+    __iadd__ = _invalidatingIndex(list.__iadd__)
+    __imul__ = _invalidatingIndex(list.__imul__)
+    del _invalidatingIndex
+
+    def _renderChild(self, child, write, indentation):
+        if isinstance(child, _MDLParent):
+            child.render(write, indentation)
+        else:
+            write(child.mdl(indentation))
+
+    def mdl(self, *args):
+        parts = []
+        self.render(parts.append, *args)
+        return "".join(parts)
+
     def addGroup(self, *args):
         result = MDLGroup(*args)
         self.append(result)
@@ -59,19 +164,23 @@ class _MDLParent(list):
         return self
 
     def tag(self, name):
-        for child in self:
-            if isinstance(child, MDLTag) and child.name() == name:
-                return child
+        index = self._index if self._index is not None else self._buildIndex()
+        children = index.get((MDLTag, name))
+        if children:
+            return children[0]
 
     def group(self, name, value = None):
-        for child in self:
-            if isinstance(child, MDLGroup) and child.name() == name and \
-              child.value() == value:
+        index = self._index if self._index is not None else self._buildIndex()
+        for child in index.get((MDLGroup, name), ()):
+            if child.value() == value:
                 return child
     
 
 class MDLGroup(_MDLParent):
+    __slots__ = ('tagName', 'tagValue')
+
     def __init__(self, tagName, tagValue = None):
+        _MDLParent.__init__(self)
         self.tagName = tagName
         self.tagValue = tagValue
 
@@ -81,16 +190,28 @@ class MDLGroup(_MDLParent):
     def value(self):
         return self.tagValue
 
-    def mdl(self, indentation = ""):
-        content = [child.mdl(indentation + "  ")
-                   for child in self]
-        result = indentation + self.tagName
+    def render(self, write, indentation = ""):
+        """Stream MDL code of this group (same as mdl() would return)
+        by calling `write` with consecutive chunks of text."""
+        write(indentation)
+        write(self.tagName)
         if self.tagValue is not None:
-            result += " " + mdlValue(self.tagValue)
-        if content:
-            return "%s {\n%s\n%s}" % (result, "\n".join(content), indentation)
-        else:
-            return "%s {}" % (result, )
+            write(" ")
+            write(mdlValue(self.tagValue))
+        if not self:
+            write(" {}")
+            return
+        write(" {\n")
+        childIndentation = _indentChildren(indentation)
+        separator = None
+        for child in self:
+            if separator:
+                write(separator)
+            separator = "\n"
+            self._renderChild(child, write, childIndentation)
+        write("\n")
+        write(indentation)
+        write("}")
 
 
 class MDLNewline(object):
@@ -109,12 +230,24 @@ class MDLComment(object):
 
 
 class MDLFile(_MDLParent):
-    def mdl(self):
-        return "\n".join(element.mdl() for element in self) + "\n"
+    __slots__ = ()
+
+    def render(self, write):
+        """Stream MDL code of this file (same as mdl() would return)
+        by calling `write` with consecutive chunks of text.  For
+        example, pass the write method of a file object in order to
+        save memory for large files."""
+        separator = None
+        for element in self:
+            if separator:
+                write(separator)
+            separator = "\n"
+            self._renderChild(element, write, "")
+        write("\n")
 
     def write(self, filename):
         with open(filename, 'w') as f:
-            f.write(self.mdl())
+            self.render(f.write)
 
 
 class MDLInclude(object):
@@ -124,6 +257,34 @@ class MDLInclude(object):
     def mdl(self, indentation = ""):
         return "%s#include %s" % (indentation, mdlValue(self.include))
 
+class MDLVerbatim(object):
+    """Pre-rendered MDL code (e.g. the result of another element's
+    mdl() method), which is output unchanged.  Note that the code is
+    not re-indented, so it should be rendered for the indentation it
+    will be used with."""
+    def __init__(self, code):
+        self.code = code
+
+    def mdl(self, indentation = ""):
+        return self.code
+
+class MDLCached(object):
+    """Wraps a constant MDL element (which must not be modified
+    anymore), memoizing its MDL code per indentation.  Useful for
+    fragments that are repeated in many generated files."""
+    __slots__ = ('element', '_code')
+
+    def __init__(self, element):
+        self.element = element
+        self._code = {}
+
+    def mdl(self, indentation = ""):
+        try:
+            return self._code[indentation]
+        except KeyError:
+            result = self._code[indentation] = self.element.mdl(indentation)
+            return result
+
 # --------------------------------------------------------------------
 
 def test_simple_quoting():
@@ -152,6 +313,54 @@ def test_hierarchy():
   }
 }"""
 
+def test_streaming():
+    f = MDLFile()
+    f.append(MDLComment('MDL v1 utf8'))
+    g = f.addGroup("myGroup", "exampleGroup").addTag(normalTag = "tag")
+    g.addGroup('emptyGroup')
+    g.append(MDLNewline)
+    g.addGroup('groupInside').addTag(multiLine = "two\nlines")
+    f.append(MDLNewline)
+    f.append(MDLInclude('$(LOCAL)/other.script'))
+    chunks = []
+    f.render(chunks.append)
+    assert "".join(chunks) == f.mdl() == """// MDL v1 utf8
+myGroup exampleGroup {
+  normalTag = tag
+  emptyGroup {}
+
+  groupInside {
+    multiLine = "*two
+lines*"
+  }
+}
+
+#include $(LOCAL)/other.script
+"""
+
+def test_lookup():
+    g = MDLGroup('Parameters')
+    g.addTag(title = 'example')
+    assert g.tag('title').value() == 'example'
+    assert g.tag('value') is None
+    first = g.addGroup('Field', 'first')
+    g.addGroup('Field', 'second').addTag(type_ = 'Bool')
+    g.append(MDLNewline)
+    assert g.group('Field', 'second').tag('type').value() == 'Bool'
+    assert g.group('Field') is None
+    g.remove(first)
+    assert g.group('Field', 'first') is None
+    g.insert(0, MDLTag(title = 'other'))
+    assert g.tag('title').value() == 'other'
+    g.group('Field', 'second').tagValue = 'renamed'
+    assert g.group('Field', 'renamed') is not None
+
+def test_cached():
+    g = MDLGroup('Field', 'cached').addTag(type_ = 'Bool')
+    c = MDLCached(g)
+    assert c.mdl() == g.mdl()
+    assert c.mdl("  ") == g.mdl("  ") == "  Field cached {\n    type = Bool\n  }"
+
 def test_tagOnlyGroup():
     g = MDLGroup('tagOnlyGroup')
     g.append(MDLTag(normalTag = "This group has no value"))
@@ -0,0 +1,98 @@
+# Copyright (c) Fraunhofer MEVIS, Germany. All rights reserved.
+# **InsertLicense** code
+"""Benchmark for the latency of noticing terminated CLI processes.
+
+Runs a short command (by default, a Python interpreter doing nothing)
+many times and measures the wall time from spawning it until its
+termination has been noticed, using the following strategies:
+
+blocking
+  process.wait() (lower bound, not usable on the GUI thread)
+sleep-poll
+  polling every 0.1s, like the former synchronous CLIModuleBackend.tryUpdate
+callLater-poll
+  polling every 0.15s, like the former runInBackground_WIP mode
+notifier
+  `cli_completion.CompletionNotifier.waitProcessingEvents` (the waiter
+  thread path without Qt; with Qt, the main thread is woken up via a
+  QSocketNotifier instead)
+
+Results are printed (or written with --output) as JSON, e.g.::
+
+  python benchmarks/completion_latency_benchmark.py --runs 50 -o latency.json
+"""
+
+import os, sys, json, time, argparse, platform, subprocess, statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'Modules', 'Scripts', 'python'))
+
+from cli_completion import CompletionNotifier
+
+def _blocking(process):
+    process.wait()
+
+def _poller(interval):
+    def wait(process):
+        while process.poll() is None:
+            time.sleep(interval)
+    return wait
+
+def _notifier(process):
+    CompletionNotifier(process).waitProcessingEvents(lambda: None)
+
+STRATEGIES = (
+    ('blocking', _blocking),
+    ('sleep-poll', _poller(0.1)),
+    ('callLater-poll', _poller(0.15)),
+    ('notifier', _notifier),
+    )
+
+def measure(command, wait, runs):
+    """Return list of `runs` end-to-end wall times (seconds)."""
+    result = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        process = subprocess.Popen(command, stdout = subprocess.DEVNULL)
+        wait(process)
+        result.append(time.perf_counter() - start)
+    return result
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__.split('\n\n')[0])
+    parser.add_argument('--runs', type = int, default = 20,
+                        help = 'number of runs per strategy (default: %(default)s)')
+    parser.add_argument('--command', nargs = '+', default = [sys.executable, '-c', 'pass'],
+                        help = 'short-running command to execute (default: python -c pass)')
+    parser.add_argument('--output', '-o', default = None,
+                        help = 'write JSON results to this file (default: stdout)')
+    args = parser.parse_args(argv)
+
+    results = []
+    for name, wait in STRATEGIES:
+        times = measure(args.command, wait, args.runs)
+        results.append(dict(strategy = name, min = min(times), median = statistics.median(times),
+                            mean = statistics.mean(times), max = max(times)))
+    baseline = results[0]['median']
+    for result in results:
+        result['overhead'] = result['median'] - baseline
+        sys.stderr.write('%-15s median %.4fs (overhead %+.4fs), min %.4fs, max %.4fs\n' % (
+            result['strategy'], result['median'], result['overhead'],
+            result['min'], result['max']))
+
+    report = dict(benchmark = 'completionLatency',
+                  timestamp = time.strftime('%Y-%m-%dT%H:%M:%S'),
+                  python = platform.python_version(),
+                  platform = platform.platform(),
+                  command = args.command,
+                  runs = args.runs,
+                  results = results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent = 1)
+    else:
+        json.dump(report, sys.stdout, indent = 1)
+        sys.stdout.write('\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+# Copyright (c) Fraunhofer MEVIS, Germany. All rights reserved.
+# **InsertLicense** code
+"""Benchmark for the image formats used for exchanging images with CLI modules.
+
+Every run of a CLI module saves its input images and loads its output
+images via temporary files (and the CLI reads/writes them, too), so
+the cost of writing and reading these files is paid twice per image
+and run.  This benchmark writes and reads synthetic volumes of
+different sizes in all candidate formats (with and without
+compression) using SimpleITK, i.e. the same ITK I/O code that is used
+by MeVisLab's itkImageFileReader/Writer and most CLI modules, and
+reports wall times and file sizes.  The results back the choice of
+`cli_module_backend.TEMPORARY_IMAGE_FORMATS`.
+
+Results are printed (or written with --output) as JSON, e.g.::
+
+  python benchmarks/image_format_benchmark.py --sizes 64 128 256 512 -o formats.json
+
+Requires SimpleITK (pip install SimpleITK).
+"""
+
+import os, sys, json, time, shutil, argparse, platform, tempfile
+
+# (extension, useCompression) combinations to compare:
+FORMATS = (
+    ('.nrrd', False),
+    ('.nrrd', True),
+    ('.mha', False),
+    ('.mha', True),
+    ('.nii', False),
+    ('.nii.gz', True),
+    ('.mhd', False), # (plus .raw file)
+    )
+
+DEFAULT_SIZES = (64, 128, 256, 512)
+
+PIXEL_TYPES = ('int16', 'float32')
+
+def syntheticVolume(sitk, size, pixelType):
+    """Return size^3 volume with smooth structures and some noise (so
+    that compression ratios are roughly realistic)."""
+    result = sitk.GaussianSource(
+        sitk.sitkFloat32, [size] * 3, sigma = [size / 4.0] * 3,
+        mean = [size / 2.0] * 3, scale = 1000)
+    noise = sitk.AdditiveGaussianNoise(result, standardDeviation = 20, seed = 42)
+    if pixelType == 'int16':
+        noise = sitk.Cast(noise, sitk.sitkInt16)
+    noise.SetSpacing((0.8, 0.8, 1.5))
+    return noise
+
+def _filesSize(filename):
+    result = os.path.getsize(filename)
+    if filename.endswith('.mhd'):
+        result += os.path.getsize(filename[:-4] + '.raw')
+    return result
+
+def benchmarkFormat(sitk, image, directory, extension, useCompression, repeat):
+    """Return dict with best-of-`repeat` 'write' and 'read' wall times
+    (seconds) and the resulting file 'bytes'."""
+    filename = os.path.join(directory, 'volume' + extension)
+    writeTimes, readTimes = [], []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        sitk.WriteImage(image, filename, useCompression)
+        writeTimes.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        sitk.ReadImage(filename)
+        readTimes.append(time.perf_counter() - start)
+    return dict(write = min(writeTimes), read = min(readTimes),
+                bytes = _filesSize(filename))
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type = int, nargs = '+', default = DEFAULT_SIZES,
+                        help = 'edge lengths of the cubic test volumes (default: %(default)s)')
+    parser.add_argument('--pixel-types', nargs = '+', choices = PIXEL_TYPES,
+                        default = PIXEL_TYPES,
+                        help = 'voxel types of the test volumes (default: %(default)s)')
+    parser.add_argument('--repeat', type = int, default = 3,
+                        help = 'number of runs per format, the best is reported (default: %(default)s)')
+    parser.add_argument('--workdir', default = None,
+                        help = 'directory for the written files (default: temporary; '
+                        'note that the file system matters, e.g. tmpfs vs. disk)')
+    parser.add_argument('--output', '-o', default = None,
+                        help = 'write JSON results to this file (default: stdout)')
+    args = parser.parse_args(argv)
+
+    try:
+        import SimpleITK as sitk
+    except ImportError:
+        parser.error('SimpleITK is required for this benchmark')
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix = 'cli_format_benchmark_')
+    results = []
+    try:
+        for size in args.sizes:
+            for pixelType in args.pixel_types:
+                image = syntheticVolume(sitk, size, pixelType)
+                for extension, useCompression in FORMATS:
+                    timing = benchmarkFormat(sitk, image, workdir, extension,
+                                             useCompression, args.repeat)
+                    results.append(dict(size = size, pixelType = pixelType,
+                                        format = extension, compressed = useCompression,
+                                        **timing))
+                    sys.stderr.write('%4d^3 %-7s %-7s %-12s write %.3fs, read %.3fs, %6.1f MB\n' % (
+                        size, pixelType, extension,
+                        'compressed' if useCompression else 'uncompressed',
+                        timing['write'], timing['read'], timing['bytes'] / 1e6))
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors = True)
+
+    report = dict(benchmark = 'imageFormats',
+                  timestamp = time.strftime('%Y-%m-%dT%H:%M:%S'),
+                  python = platform.python_version(),
+                  platform = platform.platform(),
+                  simpleITK = sitk.Version_VersionString(),
+                  repeat = args.repeat,
+                  results = results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent = 1)
+    else:
+        json.dump(report, sys.stdout, indent = 1)
+        sys.stdout.write('\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+# Copyright (c) Fraunhofer MEVIS, Germany. All rights reserved.
+# **InsertLicense** code
+"""Benchmark for importing CLI modules, using a synthetic corpus.
+
+Generates N synthetic CLI executables (small scripts that print a
+generated XML description when called with --xml) and times the
+phases of an import separately:
+
+discovery
+  finding the executables (`cli_discovery.findCLIExecutables`)
+extraction
+  running them with --xml and parsing the XML (`cli_to_macro.loadCLIModule`)
+mdlDescription
+  building the MDL trees (`cli_to_macro.mdlDescription`)
+writing
+  writing all generated files (`cli_to_macro.writeMDLFile`)
+
+Results are printed (or written with --output) as JSON, so that they
+can be compared between revisions, e.g.::
+
+  python benchmarks/import_benchmark.py --scales 10 100 1000 --jobs 8 -o before.json
+"""
+
+import os, sys, json, time, random, shutil, argparse, platform, tempfile, logging
+from xml.sax.saxutils import escape
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'Modules', 'Scripts', 'python'))
+
+import cli_to_macro, cli_discovery
+from mdl_writer import MDLFile, MDLNewline
+
+DEFAULT_SCALES = (10, 100, 1000, 5000)
+
+# relative frequencies of parameter kinds within the generated CLIs
+PARAMETER_MIXES = {
+    'mixed'        : dict(scalar = 4, enumeration = 2, vector = 2, image = 2, file = 1),
+    'enumerations' : dict(scalar = 1, enumeration = 6, image = 1),
+    'vectors'      : dict(scalar = 1, vector = 6, image = 1),
+    'images'       : dict(scalar = 1, image = 6),
+    }
+
+LOREM = ("Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do "
+         "eiusmod tempor incididunt ut labore et dolore magna aliqua. ").split()
+
+def _text(rng, words):
+    return " ".join(rng.choice(LOREM) for _ in range(words))
+
+def _parameterXML(rng, kind, index, positionalIndex, longDescriptions):
+    name = '%s%d' % (kind, index)
+    description = _text(rng, rng.randint(40, 400) if longDescriptions else rng.randint(3, 20))
+    common = '<name>%s</name><label>%s %d</label><description>%s</description>' % (
+        name, kind.title(), index, escape(description))
+    if kind == 'image':
+        channel = rng.choice(('input', 'output'))
+        return '<image>%s<channel>%s</channel><index>%d</index></image>' % (
+            common, channel, positionalIndex)
+    flag = '<longflag>--%s</longflag>' % name
+    if kind == 'scalar':
+        typ = rng.choice(('integer', 'float', 'double', 'boolean', 'string'))
+        default = dict(integer = '3', float = '0.5', double = '1e-3',
+                       boolean = 'false', string = 'some value')[typ]
+        constraints = ''
+        if typ in ('integer', 'float', 'double'):
+            constraints = ('<constraints><minimum>0</minimum><maximum>100</maximum>'
+                           '<step>1</step></constraints>')
+        return '<%s>%s%s<default>%s</default>%s</%s>' % (
+            typ, common, flag, default, constraints, typ)
+    if kind == 'enumeration':
+        typ = rng.choice(('string', 'integer', 'double'))
+        elements = (['option %d' % i for i in range(rng.randint(2, 40))] if typ == 'string'
+                    else [str(i) for i in range(rng.randint(2, 40))])
+        return '<%s-enumeration>%s%s<default>%s</default>%s</%s-enumeration>' % (
+            typ, common, flag, escape(elements[0]),
+            ''.join('<element>%s</element>' % escape(e) for e in elements), typ)
+    if kind == 'vector':
+        typ = rng.choice(('integer', 'float', 'double'))
+        return '<%s-vector>%s%s<default>%s</default></%s-vector>' % (
+            typ, common, flag, ','.join(str(i) for i in range(rng.randint(2, 6))), typ)
+    assert kind == 'file'
+    return '<file>%s%s<channel>input</channel></file>' % (common, flag)
+
+def syntheticXML(rng, index, mix = 'mixed', longDescriptions = False):
+    """Return XML description of a synthetic CLI module."""
+    weights = PARAMETER_MIXES[mix]
+    kinds = [kind for kind, weight in sorted(weights.items()) for _ in range(weight)]
+    groups = []
+    parameterIndex = positionalIndex = 0
+    for groupIndex in range(rng.randint(1, 4)):
+        parameters = []
+        for _ in range(rng.randint(2, 12)):
+            kind = rng.choice(kinds)
+            parameters.append(_parameterXML(rng, kind, parameterIndex, positionalIndex,
+                                            longDescriptions))
+            parameterIndex += 1
+            if kind == 'image':
+                positionalIndex += 1
+        groups.append(parameters)
+    return '''<?xml version="1.0" encoding="utf-8"?>
+<executable>
+  <category>Benchmark.Synthetic</category>
+  <title>Synthetic CLI %d</title>
+  <description>%s</description>
+  <version>1.0.%d</version>
+  <documentation-url>http://example.org/cli/%d</documentation-url>
+  <contributor>Jane Doe (Example Org), John Roe</contributor>
+%s
+</executable>
+''' % (index, escape(_text(rng, 200 if longDescriptions else 20)), index, index,
+       '\n'.join('  <parameters%s>\n    <label>Group %d</label>\n    <description>%s</description>\n    %s\n  </parameters>' % (
+           ' advanced="true"' if i else '', i, escape(_text(rng, 10)), '\n    '.join(parameters))
+                 for i, parameters in enumerate(groups)))
+
+def generateCorpus(directory, count, mix = 'mixed', longDescriptions = False,
+                   interpreter = 'sh', seed = 42):
+    """Create `count` synthetic CLI executables within `directory`.
+    With interpreter 'sh', each executable is a tiny shell script
+    cat'ting an XML file next to it (cheapest possible process
+    start), with 'python', a Python script embedding the XML."""
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok = True)
+    for index in range(count):
+        xml = syntheticXML(rng, index, mix, longDescriptions)
+        executable = os.path.join(directory, 'SyntheticCLI%05d' % index)
+        if interpreter == 'sh':
+            with open(executable + '.xml', 'w') as f:
+                f.write(xml)
+            script = '#!/bin/sh\nexec cat "$0.xml"\n'
+        else:
+            script = '#!%s\nimport sys\nif "--xml" in sys.argv:\n    sys.stdout.write(%r)\n' % (
+                sys.executable, xml)
+        with open(executable, 'w') as f:
+            f.write(script)
+        os.chmod(executable, 0o755)
+
+def _timed(function, *args, **kwargs):
+    startWall, startCPU = time.perf_counter(), time.process_time()
+    result = function(*args, **kwargs)
+    return result, dict(wall = time.perf_counter() - startWall,
+                        cpu = time.process_time() - startCPU)
+
+def benchmarkImport(corpusDirectory, targetDirectory, jobs = None):
+    """Time the phases of importing all CLIs in `corpusDirectory` into
+    `targetDirectory`; returns dict mapping phase names to dicts with
+    'wall' and 'cpu' seconds."""
+    cli_discovery.clearDiscoveryCache()
+    paths, discovery = _timed(cli_discovery.findCLIExecutables, [corpusDirectory])
+
+    def extract():
+        if jobs is not None and jobs > 1:
+            return [future.result()[0] for future in
+                    cli_to_macro._loadCLIModulesInParallel(paths, jobs, None, None, None)]
+        return [cli_to_macro.loadCLIModule(path, timeout = None) for path in paths]
+    modules, extraction = _timed(extract)
+
+    descriptions, description = _timed(
+        lambda: [cli_to_macro.mdlDescription(m) for m in modules])
+
+    def write():
+        defFile = MDLFile()
+        for m, (mdefFile, scriptFile, mlabFile, mhelpFile) in zip(modules, descriptions):
+            if defFile:
+                defFile.append(MDLNewline)
+            defFile.extend(mdefFile)
+            cli_to_macro.writeMDLFile(scriptFile, os.path.join(targetDirectory, "%s.script" % m.name))
+            cli_to_macro.writeMDLFile(mlabFile, os.path.join(targetDirectory, "%s.mlab" % m.name))
+            cli_to_macro.writeMDLFile(mhelpFile, os.path.join(targetDirectory, "mhelp", "CLI_%s.mhelp" % m.name))
+        cli_to_macro.writeMDLFile(defFile, os.path.join(targetDirectory, "CLIModules.def"))
+    _, writing = _timed(write)
+
+    return dict(discovery = discovery, extraction = extraction,
+                mdlDescription = description, writing = writing)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__.split('\n\n')[0])
+    parser.add_argument('--scales', type = int, nargs = '+', default = DEFAULT_SCALES,
+                        help = 'numbers of synthetic CLI modules (default: %(default)s)')
+    parser.add_argument('--mix', choices = sorted(PARAMETER_MIXES), default = 'mixed',
+                        help = 'parameter mix of the synthetic CLIs (default: %(default)s)')
+    parser.add_argument('--long-descriptions', action = 'store_true',
+                        help = 'generate long module / parameter descriptions')
+    parser.add_argument('--interpreter', choices = ('sh', 'python'),
+                        default = 'python' if os.name != 'posix' else 'sh',
+                        help = 'implementation of the synthetic executables (default: %(default)s)')
+    parser.add_argument('--jobs', '-j', type = int, default = None,
+                        help = 'parallel extraction jobs (default: serial)')
+    parser.add_argument('--repeat', type = int, default = 1,
+                        help = 'number of runs per scale (default: %(default)s)')
+    parser.add_argument('--workdir', default = None,
+                        help = 'directory for corpus and output (default: temporary)')
+    parser.add_argument('--output', '-o', default = None,
+                        help = 'write JSON results to this file (default: stdout)')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level = logging.ERROR) # synthetic CLIs trigger (harmless) warnings
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix = 'cli_import_benchmark_')
+    results = []
+    try:
+        for count in args.scales:
+            corpus = os.path.join(workdir, 'corpus-%d' % count)
+            if not os.path.isdir(corpus):
+                generateCorpus(corpus, count, args.mix, args.long_descriptions,
+                               args.interpreter)
+            for run in range(args.repeat):
+                target = os.path.join(workdir, 'generated-%d-%d' % (count, run))
+                shutil.rmtree(target, ignore_errors = True)
+                os.makedirs(os.path.join(target, 'mhelp'))
+                phases = benchmarkImport(corpus, target, args.jobs)
+                results.append(dict(modules = count, run = run, phases = phases))
+                sys.stderr.write('%5d modules: %s\n' % (count, ', '.join(
+                    '%s %.3fs' % (phase, timing['wall']) for phase, timing in phases.items())))
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors = True)
+
+    report = dict(benchmark = 'import',
+                  timestamp = time.strftime('%Y-%m-%dT%H:%M:%S'),
+                  python = platform.python_version(),
+                  platform = platform.platform(),
+                  cpus = os.cpu_count(),
+                  settings = dict(mix = args.mix, longDescriptions = args.long_descriptions,
+                                  interpreter = args.interpreter, jobs = args.jobs),
+                  results = results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent = 1)
+    else:
+        json.dump(report, sys.stdout, indent = 1)
+        sys.stdout.write('\n')
+
+if __name__ == '__main__':
+    main()
@@ -7,5 +7,5 @@ import cli_to_macro
 
 args = sys.argv[1:] or ['/Applications/Slicer.app/Contents/lib/Slicer-4.2/cli-modules']
 
-for index, total, path in cli_to_macro.importAllCLIs(args, 'mdl'):
-        print "%d/%d importing %s..." % (index, total, path)
+for index, successful, total, path in cli_to_macro.importAllCLIs(args, 'mdl'):
+        print("%d/%d importing %s..." % (index, total, path))